@@ -1,7 +1,9 @@
+import functools
 import inspect
 
 from statu.models import Event, State, InvalidStateTransition
-from statu.orm import get_adaptor
+from statu.machine import describe_machine
+from statu.orm import get_adaptor, register_adaptor, unregister_adaptor
 
 _temp_callback_cache = None
 
@@ -17,38 +19,35 @@ def get_function_name(frame):
     return inspect.getouterframes(frame)[1][3]
 
 
-def before(before_what):
-    def wrapper(func):
-        frame = inspect.currentframe()
-        calling_class = get_function_name(frame)
+def _callback_decorator(when):
+    def register(what):
+        def wrapper(func):
+            frame = inspect.currentframe()
+            calling_class = get_function_name(frame)
 
-        calling_class_dict = get_callback_cache().setdefault(
-            calling_class, {"before": {}, "after": {}}
-        )
-        calling_class_dict["before"].setdefault(before_what, []).append(func)
+            calling_class_dict = get_callback_cache().setdefault(
+                calling_class, {"before": {}, "after": {}}
+            )
+            calling_class_dict.setdefault(when, {}).setdefault(what, []).append(func)
 
-        return func
+            return func
 
-    return wrapper
+        return wrapper
 
+    return register
 
-def after(after_what):
-    def wrapper(func):
-        frame = inspect.currentframe()
-        calling_class = get_function_name(frame)
 
-        calling_class_dict = get_callback_cache().setdefault(
-            calling_class, {"before": {}, "after": {}}
-        )
-        calling_class_dict["after"].setdefault(after_what, []).append(func)
+before = _callback_decorator("before")
+after = _callback_decorator("after")
+after_batch = _callback_decorator("after_batch")
+on_enter = _callback_decorator("enter")
+on_exit = _callback_decorator("exit")
 
-        return func
 
-    return wrapper
-
-
-def acts_as_state_machine(original_class):
-    adaptor = get_adaptor(original_class)
+def acts_as_state_machine(original_class=None, **options):
+    if original_class is None:
+        return functools.partial(acts_as_state_machine, **options)
+    adaptor = get_adaptor(original_class, **options)
     global _temp_callback_cache
     modified_class = adaptor.modifed_class(original_class, _temp_callback_cache)
     _temp_callback_cache = None
@@ -0,0 +1,18 @@
+"""Asyncio driver for :class:`statu.timeouts.TimeoutScheduler`.
+
+Kept apart from :mod:`statu.timeouts` because ``async def`` is a syntax
+error on Python 2; it is only imported by ``run_async``.
+"""
+
+import asyncio
+
+
+async def run_scheduler(scheduler, poll_interval):
+    scheduler._running = True
+    while scheduler._running:
+        scheduler._run_pending_logged()
+        deadline = scheduler.next_deadline()
+        delay = poll_interval
+        if deadline is not None:
+            delay = min(max(deadline - scheduler.clock(), 0), poll_interval)
+        await asyncio.sleep(delay)
@@ -0,0 +1,57 @@
+from __future__ import absolute_import
+
+import collections
+import threading
+import time
+
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    _monotonic = time.time
+
+
+class StateCache(object):
+    """Thread-safe LRU mapping of primary key to state name with a TTL.
+
+    Holds at most ``maxsize`` entries; entries older than ``ttl`` seconds are
+    treated as missing.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0, clock=_monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            state_name, expires = entry
+            if expires <= self.clock():
+                del self._data[key]
+                return None
+            # pop and reinsert to mark it most recently used; unlike
+            # move_to_end this also works on Python 2
+            self._data[key] = self._data.pop(key)
+            return state_name
+
+    def set(self, key, state_name):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (state_name, self.clock() + self.ttl)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,173 @@
+from __future__ import absolute_import
+
+import collections
+import json
+
+from statu.models import Event, State
+from statu.orm.base import _get_callbacks
+
+_descriptors = {}
+
+
+class MachineDescriptor(
+    collections.namedtuple(
+        "MachineDescriptor", ["states", "initial", "events", "callbacks", "timeouts"]
+    )
+):
+    """Immutable, hashable summary of a decorated class's state machine.
+
+    Descriptors are shared by every class with an equal machine, so they do
+    not hold a class name; the exporters take it as ``name``.
+
+    ``states`` holds the state names in declaration order, ``events`` a
+    ``(name, from_states, to_state)`` triple per event, ``callbacks`` a
+    ``((kind, name), count)`` pair per registered callback hook and
+    ``timeouts`` a ``(state, seconds, event)`` triple per timed state.
+    """
+
+    __slots__ = ()
+
+    @property
+    def transitions(self):
+        return tuple(
+            (from_state, event_name, to_state)
+            for event_name, from_states, to_state in self.events
+            for from_state in from_states
+        )
+
+    def to_dict(self, name=None):
+        machine = {
+            "states": list(self.states),
+            "initial": self.initial,
+            "events": [
+                {
+                    "name": event_name,
+                    "from_states": list(from_states),
+                    "to_state": to_state,
+                }
+                for event_name, from_states, to_state in self.events
+            ],
+            "callbacks": [
+                {"kind": kind, "name": hook_name, "count": count}
+                for (kind, hook_name), count in self.callbacks
+            ],
+            "timeouts": [
+                {"state": state_name, "timeout": seconds, "event": event_name}
+                for state_name, seconds, event_name in self.timeouts
+            ],
+        }
+        if name is not None:
+            machine["name"] = name
+        return machine
+
+    def to_json(self, name=None, **kwargs):
+        return json.dumps(self.to_dict(name), **kwargs)
+
+    def to_dot(self, name=None):
+        header = (
+            "digraph {" if name is None else "digraph {} {{".format(json.dumps(name))
+        )
+        lines = [header, "    rankdir=LR;"]
+        for state_name in self.states:
+            shape = "doublecircle" if state_name == self.initial else "circle"
+            lines.append("    {} [shape={}];".format(json.dumps(state_name), shape))
+        for from_state, event_name, to_state in self.transitions:
+            lines.append(
+                "    {} -> {} [label={}];".format(
+                    json.dumps(from_state), json.dumps(to_state), json.dumps(event_name)
+                )
+            )
+        lines.append("}")
+        return "\n".join(lines)
+
+
+def describe_machine(document_class):
+    """Return the :class:`MachineDescriptor` of a decorated class.
+
+    Built once per class and cached on it. Subclasses that declare no states,
+    events or callbacks of their own share their parent's descriptor, and
+    equal descriptors are interned to a single object.
+    """
+    descriptor = document_class.__dict__.get("_machine_descriptor")
+    if descriptor is not None:
+        return descriptor
+    if document_class._state_adaptor.initial_state is None and hasattr(
+        document_class, "_sa_class_manager"
+    ):
+        # sqlalchemy models get their machine once the mappers are configured
+        from sqlalchemy.orm import configure_mappers
+
+        configure_mappers()
+    parent = None
+    for base in document_class.__mro__[1:]:
+        if hasattr(base, "_state_adaptor"):
+            parent = base
+            break
+    if parent is not None and not _changes_machine(document_class):
+        descriptor = describe_machine(parent)
+    else:
+        descriptor = _build_descriptor(document_class)
+    if document_class._state_adaptor.initial_state is None:
+        # not processed yet, so not worth keeping
+        return descriptor
+    descriptor = _descriptors.setdefault(descriptor, descriptor)
+    setattr(document_class, "_machine_descriptor", descriptor)
+    return descriptor
+
+
+def _changes_machine(document_class):
+    members = vars(document_class)
+    if "_state_adaptor" in members:
+        return True
+    callback_cache = members.get("callback_cache")
+    if callback_cache and document_class.__name__ in callback_cache:
+        return True
+    return any(isinstance(value, (State, Event)) for value in members.values())
+
+
+def _build_descriptor(document_class):
+    adaptor = document_class._state_adaptor
+
+    # declaration order, with inherited members first
+    order = {}
+    for clazz in reversed(document_class.__mro__):
+        for member in vars(clazz):
+            order.setdefault(member, len(order))
+    states = tuple(sorted(adaptor.states, key=lambda name: order.get(name, 0)))
+    event_names = sorted(adaptor.events, key=lambda name: order.get(name, 0))
+
+    initial = None
+    for state_name in states:
+        if adaptor.state_objects[state_name].initial:
+            initial = state_name
+
+    events = []
+    hooks = []
+    for event_name in event_names:
+        event = adaptor.events[event_name]
+        from_states = tuple(from_state.name for from_state in event.from_states)
+        events.append((event_name, from_states, event.to_state.name))
+        for kind in ("before", "after", "after_batch"):
+            hooks.append((kind, event_name))
+    for state_name in states:
+        hooks.extend([("enter", state_name), ("exit", state_name)])
+
+    callbacks = []
+    for kind, name in hooks:
+        count = len(_get_callbacks(document_class, kind, name))
+        if count:
+            callbacks.append(((kind, name), count))
+
+    timeouts = tuple(
+        (state_name,) + adaptor.state_timeouts[state_name]
+        for state_name in states
+        if state_name in adaptor.state_timeouts
+    )
+
+    return MachineDescriptor(
+        states,
+        initial,
+        tuple(events),
+        tuple(callbacks),
+        timeouts,
+    )
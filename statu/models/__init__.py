@@ -1,3 +1,5 @@
+import datetime
+
 try:
     string_type = basestring
 except NameError:
@@ -9,8 +11,14 @@ class InvalidStateTransition(Exception):
 
 
 class State(object):
-    def __init__(self, initial=False, **kwargs):
+    def __init__(self, initial=False, timeout=None, on_timeout=None, **kwargs):
         self.initial = initial
+        if isinstance(timeout, datetime.timedelta):
+            timeout = timeout.total_seconds()
+        if timeout is not None and on_timeout is None:
+            raise ValueError("a timed state needs an on_timeout event name")
+        self.timeout = timeout
+        self.on_timeout = on_timeout
 
     def __eq__(self, other):
         if isinstance(other, string_type):
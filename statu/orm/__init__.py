@@ -1,25 +1,65 @@
 from __future__ import absolute_import
 
+import six
+
 from statu.orm.base import BaseAdaptor
-from statu.orm.sqlalchemy import get_sqlalchemy_adaptor
+from statu.orm.keyvalue import get_keyvalue_adaptor
+from statu.orm.shared import get_shared_state_adaptor
+
+
+def get_sqlalchemy_adaptor(original_class, **options):
+    # sqlalchemy is only imported once a mapped class shows up
+    if not hasattr(original_class, "_sa_class_manager"):
+        return None
+    from statu.orm import sqlalchemy
+
+    return sqlalchemy.get_sqlalchemy_adaptor(original_class, **options)
+
+
+_adaptors = [get_sqlalchemy_adaptor, get_shared_state_adaptor, get_keyvalue_adaptor]
 
-_adaptors = [get_sqlalchemy_adaptor]
 
+def register_adaptor(factory):
+    """Register ``factory(original_class, **options)`` ahead of the built-in adaptors.
 
-def get_adaptor(original_class):
+    The factory returns an adaptor instance for classes it handles and
+    ``None`` otherwise. Usable as a decorator.
+    """
+    _adaptors.insert(0, factory)
+    return factory
+
+
+def unregister_adaptor(factory):
+    _adaptors.remove(factory)
+
+
+def get_adaptor(original_class, **options):
     # if none, then just keep state in memory
     for get_adaptor in _adaptors:
-        adaptor = get_adaptor(original_class)
+        adaptor = get_adaptor(original_class, **options)
         if adaptor is not None:
             break
     else:
-        adaptor = NullAdaptor(original_class)
+        adaptor = NullAdaptor(original_class, **options)
     return adaptor
 
 
 class NullAdaptor(BaseAdaptor):
+    @property
+    def plain_update(self):
+        # subclasses overriding the write path must go through it
+        adaptor_class = type(self)
+        return (
+            not self.track_state_changes
+            and six.get_unbound_function(adaptor_class.update)
+            is six.get_unbound_function(NullAdaptor.update)
+            and six.get_unbound_function(adaptor_class.transition)
+            is six.get_unbound_function(BaseAdaptor.transition)
+        )
+
     def extra_class_members(self, initial_state):
         return {"aasm_state": initial_state.name}
 
     def update(self, document, state_name):
         document.aasm_state = state_name
+        self.record_state_change(document)
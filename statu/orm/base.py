@@ -1,30 +1,47 @@
 from __future__ import absolute_import
+import collections
+import contextlib
+import datetime
+import functools
 import inspect
+import operator
+import threading
+import time
+import weakref
 import six
 
 from statu.models import Event, State, InvalidStateTransition
+from statu.orm.codegen import compile_event_method
 
+_all_adaptors = weakref.WeakSet()
+_callback_wrapper = None
 
-def _get_callbacks(self, when, event_name):
+
+def set_callback_wrapper(wrapper):
+    """Install ``wrapper(document_class, event_name, callback)`` around every callback.
+
+    Callback tables (and compiled event methods) of all adaptors are rebuilt,
+    so with no wrapper installed the event path is exactly the unwrapped one.
+    """
+    global _callback_wrapper
+    _callback_wrapper = wrapper
+    for adaptor in list(_all_adaptors):
+        adaptor.reset_callback_tables()
+
+
+def _get_callbacks(document_class, when, name):
     callbacks = []
-    for clazz in inspect.getmro(self.__class__):
+    for clazz in inspect.getmro(document_class):
         if hasattr(clazz, "callback_cache") and clazz.callback_cache:
             if clazz.__name__ in clazz.callback_cache:
-                if event_name in clazz.callback_cache[clazz.__name__][when]:
-                    callbacks.extend(
-                        clazz.callback_cache[clazz.__name__][when][event_name]
-                    )
+                class_callbacks = clazz.callback_cache[clazz.__name__].get(when, {})
+                if name in class_callbacks:
+                    callbacks.extend(class_callbacks[name])
     return callbacks
 
 
 def _get_next_event_names(self):
-    next_event_names = set()
-    for event_name, event in six.iteritems(self.get_events()):
-        for from_state in event.from_states:
-            if from_state.name == self.current_state:
-                next_event_names.add(event_name)
-                break
-    return list(next_event_names)
+    return list(self._state_adaptor.events_by_state.get(self.current_state, ()))
 
 
 def _get_next_event_methods(self):
@@ -35,82 +52,303 @@ def _get_next_event_methods(self):
     return next_events
 
 
+def _instance_lock(document):
+    lock = document.__dict__.get("_state_lock")
+    if lock is None:
+        # setdefault is atomic, so racing threads end up sharing one lock
+        lock = document.__dict__.setdefault("_state_lock", threading.RLock())
+    return lock
+
+
+def _striped_locks(count):
+    locks = [threading.RLock() for _ in range(count)]
+
+    def lock_for(document):
+        # ids are at least 16-byte aligned
+        return locks[(id(document) >> 4) % count]
+
+    return lock_for
+
+
+@contextlib.contextmanager
+def _null_context():
+    yield
+
+
+def _adaptor_classmethod(method):
+    @functools.wraps(method)
+    def f(cls, *args, **kwargs):
+        return method(*args, **kwargs)
+
+    return classmethod(f)
+
+
 class BaseAdaptor(object):
     property_type = property
-
-    def __init__(self, original_class):
+    # whether transition() only assigns aasm_state, so compiled events can inline it
+    plain_update = False
+
+    def __init__(
+        self,
+        original_class,
+        compile_events=False,
+        locking=None,
+        track_state_changes=False,
+    ):
         self.original_class = original_class
+        self.compile_events = compile_events
+        self.track_state_changes = track_state_changes
+        self.compiled_events = {}
+        if locking is True:
+            self.lock_for = _instance_lock
+        elif locking:
+            self.lock_for = _striped_locks(locking)
+        else:
+            self.lock_for = None
+        self.states = []
+        self.state_objects = {}
+        self.state_timeouts = {}
+        self.events = {}
+        self.events_by_state = {}
+        self.initial_state = None
+        self.callback_tables = {}
+        self.parent = None
+        for clazz in original_class.__mro__[1:]:
+            if "_state_adaptor" in vars(clazz):
+                self.parent = clazz._state_adaptor
+                break
+        _all_adaptors.add(self)
+
+    def extend(self, parent):
+        """Start from copies of the machine of a decorated base class."""
+        self.states = list(parent.states)
+        self.state_objects = dict(parent.state_objects)
+        self.state_timeouts = dict(parent.state_timeouts)
+        self.events = dict(parent.events)
+        self.events_by_state = dict(
+            (state_name, list(event_names))
+            for state_name, event_names in six.iteritems(parent.events_by_state)
+        )
+        self.initial_state = parent.initial_state
 
     def get_potential_state_machine_attributes(self, clazz):
-        return inspect.getmembers(clazz)
+        if self.parent is None:
+            return inspect.getmembers(clazz)
+        # members of the decorated parent and its bases are already processed,
+        # but mixins and undecorated intermediate classes are not
+        processed = set(inspect.getmro(self.parent.original_class))
+        names = set()
+        for base in inspect.getmro(clazz):
+            if base not in processed:
+                names.update(vars(base))
+        members = []
+        for name in sorted(names):
+            try:
+                members.append((name, getattr(clazz, name)))
+            except AttributeError:
+                continue
+        return members
 
     def process_states(self, original_class):
-        initial_state = None
+        if self.parent is not None:
+            self.extend(self.parent)
+        initial_state = self.initial_state
         is_method_dict = dict()
         for member, value in self.get_potential_state_machine_attributes(
             original_class
         ):
 
             if isinstance(value, State):
+                name = getattr(value, "name", None)
+                if name is not None and self.state_objects.get(name) is value:
+                    # an inherited state under another attribute name
+                    continue
+
                 if value.initial:
-                    if initial_state is not None:
+                    if initial_state is not None and initial_state.name != member:
                         raise ValueError("multiple initial states!")
                     initial_state = value
+                elif initial_state is not None and initial_state.name == member:
+                    initial_state = None
 
-                # add its name to itself:
-                setattr(value, "name", member)
+                # add its name to itself, unless it is shared with another class
+                if name is None:
+                    setattr(value, "name", member)
+                if member not in self.state_objects:
+                    self.states.append(member)
+                self.state_objects[member] = value
+
+                self.state_timeouts.pop(member, None)
+                if value.timeout is not None:
+                    self.state_timeouts[member] = (value.timeout, value.on_timeout)
 
                 is_method_string = "is_" + member
 
                 def is_method_builder(member):
+                    # state names are interned, so equal states compare by identity
+                    state_name = six.moves.intern(str(member))
+
                     def f(self):
-                        return self.aasm_state == str(member)
+                        return self.aasm_state == state_name
 
                     return self.property_type(f)
 
                 is_method_dict[is_method_string] = is_method_builder(member)
 
+        if self.state_timeouts:
+            is_method_dict["_state_timeouts"] = self.state_timeouts
+            is_method_dict["_timeout_scheduler"] = None
+
+        self.initial_state = initial_state
         return is_method_dict, initial_state
 
+    def build_callback_table(self, document_class):
+        """Precompute the callbacks of every (event, from state) pair.
+
+        Each entry is a ``(before, after)`` pair of tuples: ``before`` holds the
+        event's before callbacks followed by the source state's exit hooks and
+        may veto the transition; ``after`` holds the target state's enter hooks
+        followed by the event's after callbacks.
+        """
+        wrapper = _callback_wrapper
+
+        def get_callbacks(when, name, event_name):
+            callbacks = _get_callbacks(document_class, when, name)
+            if wrapper is not None:
+                callbacks = [
+                    wrapper(document_class, event_name, callback)
+                    for callback in callbacks
+                ]
+            return callbacks
+
+        table = {}
+        for event_name, event in six.iteritems(self.events):
+            before = get_callbacks("before", event_name, event_name)
+            enter = get_callbacks("enter", event.to_state.name, event_name)
+            after = self.after_callbacks(
+                document_class,
+                event_name,
+                enter + get_callbacks("after", event_name, event_name),
+                get_callbacks("after_batch", event_name, event_name),
+            )
+            transitions = {}
+            for from_state in event.from_states:
+                exit_hooks = get_callbacks("exit", from_state.name, event_name)
+                transitions[from_state.name] = (tuple(before + exit_hooks), after)
+            table[event_name] = transitions
+        self.callback_tables[document_class] = table
+        return table
+
+    def reset_callback_tables(self):
+        self.callback_tables.clear()
+        for event_name, fallback in six.iteritems(self.compiled_events):
+            method = compile_event_method(
+                self, self.original_class, event_name, fallback
+            )
+            setattr(self.original_class, event_name, method)
+
+    def after_callbacks(self, document_class, event_name, callbacks, batch_callbacks):
+        """Return the tuple run once an event has changed the state.
+
+        ``batch_callbacks`` take ``(document_class, documents)``; run inline
+        they receive a batch of one.
+        """
+
+        def batch_method_builder(batch_callback):
+            def f(document):
+                return batch_callback(document_class, [document])
+
+            return f
+
+        return tuple(callbacks) + tuple(
+            batch_method_builder(batch_callback) for batch_callback in batch_callbacks
+        )
+
     def process_events(self, original_class):
         _adaptor = self
+        state_timeouts = self.state_timeouts
+        callback_tables = self.callback_tables
+        lock_for = self.lock_for
         event_method_dict = dict()
-        events = {}
+        events = self.events
         for member, value in self.get_potential_state_machine_attributes(
             original_class
         ):
             if isinstance(value, Event):
-                # Create event methods
-
-                def event_meta_method(event_name, event_description):
-                    def f(self):
-                        # assert current state
-                        if self.current_state not in event_description.from_states:
-                            raise InvalidStateTransition
-
-                        # fire before_change
-                        failed = False
-                        for callback in _get_callbacks(self, "before", event_name):
-                            result = callback(self)
-                            if result is False:
-                                print(
-                                    "One of the 'before' callbacks returned false, breaking"
-                                )
-                                failed = True
-                                break
-
-                        # change state
-                        if not failed:
-                            _adaptor.update(self, event_description.to_state.name)
-
-                            # fire after_change
-                            for callback in _get_callbacks(self, "after", event_name):
-                                callback(self)
-
-                    return f
-
-                event_method_dict[member] = event_meta_method(member, value)
+                if events.get(member) is value:
+                    continue
+                if member in events:
+                    # overridden by a subclass
+                    for event_names in six.itervalues(self.events_by_state):
+                        if member in event_names:
+                            event_names.remove(member)
                 events[member] = value
+                for from_state in value.from_states:
+                    self.events_by_state.setdefault(from_state.name, []).append(member)
+
+        # Create event methods, bound to this adaptor
+        def event_meta_method(event_name, event_description):
+            to_state_name = event_description.to_state.name
+
+            def f(self):
+                table = callback_tables.get(self.__class__)
+                if table is None:
+                    table = _adaptor.build_callback_table(self.__class__)
+
+                lock = None
+                if lock_for is not None:
+                    lock = lock_for(self)
+                    lock.acquire()
+                try:
+                    # assert current state
+                    state_name = self.aasm_state
+                    callbacks = table[event_name].get(state_name)
+                    if callbacks is None:
+                        raise InvalidStateTransition
+                    before, after = callbacks
+
+                    # fire before_change and exit hooks
+                    for callback in before:
+                        result = callback(self)
+                        if result is False:
+                            print(
+                                "One of the 'before' callbacks returned false, breaking"
+                            )
+                            return False
+
+                    # change state
+                    _adaptor.transition(self, state_name, to_state_name)
+                    if state_timeouts:
+                        scheduler = self._timeout_scheduler
+                        if scheduler is not None:
+                            scheduler.state_changed(self)
+                finally:
+                    if lock is not None:
+                        lock.release()
+
+                # fire enter hooks and after_change
+                for callback in after:
+                    callback(self)
+                return True
+
+            return f
+
+        for member, value in six.iteritems(events):
+            event_method_dict[member] = event_meta_method(member, value)
+        for state_name, (_timeout, event_name) in six.iteritems(state_timeouts):
+            event = events.get(event_name)
+            if event is None or state_name not in event.from_states:
+                raise ValueError(
+                    "timeout event {!r} of state {!r} cannot fire from it".format(
+                        event_name, state_name
+                    )
+                )
+        if self.compile_events:
+            for event_name in events:
+                self.compiled_events[event_name] = event_method_dict[event_name]
+                event_method_dict[event_name] = compile_event_method(
+                    self, original_class, event_name, event_method_dict[event_name]
+                )
         event_method_dict["get_events"] = lambda self: events
         return event_method_dict
 
@@ -120,16 +358,27 @@ class BaseAdaptor(object):
         class_dict = dict()
 
         class_dict["callback_cache"] = callback_cache
+        # compiled events resolve the class callbacks while processing
+        setattr(original_class, "callback_cache", callback_cache)
+
+        def current_state_object_method():
+            state_objects = self.state_objects
 
-        def current_state_method():
             def f(self):
-                return self.aasm_state
+                return state_objects[self.aasm_state]
 
             return property(f)
 
-        class_dict["current_state"] = current_state_method()
+        class_dict["current_state"] = property(operator.attrgetter("aasm_state"))
+        class_dict["current_state_object"] = current_state_object_method()
         class_dict["get_next_event_names"] = _get_next_event_names
         class_dict["get_next_event_methods"] = _get_next_event_methods
+        class_dict["_state_adaptor"] = self
+        class_dict.update(self.class_methods())
+        if self.track_state_changes:
+            class_dict["state_changed_at"] = None
+            class_dict["time_in_state"] = property(self.time_in_state)
+            class_dict["__init__"] = self.stamping_init(original_class.__init__)
 
         # Get states
         state_method_dict, initial_state = self.process_states(original_class)
@@ -145,8 +394,101 @@ class BaseAdaptor(object):
 
         return original_class
 
+    def batch(self):
+        """Context manager grouping the writes made inside it, if supported."""
+        return _null_context()
+
+    def flush(self, documents):
+        """Persist pending state changes of ``documents``, if buffered."""
+
+    def stamping_init(self, original_init):
+        adaptor = self
+
+        @functools.wraps(original_init)
+        def __init__(self, *args, **kwargs):
+            self.state_changed_at = adaptor.state_changed_now()
+            original_init(self, *args, **kwargs)
+
+        return __init__
+
+    def state_changed_now(self):
+        return time.time()
+
+    def record_state_change(self, document):
+        if self.track_state_changes:
+            document.state_changed_at = self.state_changed_now()
+
+    def time_in_state(self, document):
+        """Seconds ``document`` has spent in its current state."""
+        changed_at = document.state_changed_at
+        if changed_at is None:
+            return None
+        return self.state_changed_now() - changed_at
+
+    def class_methods(self):
+        class_methods = {
+            "count_by_state": _adaptor_classmethod(self.count_by_state),
+            "count_by_event": _adaptor_classmethod(self.count_by_event),
+        }
+        if self.track_state_changes:
+            class_methods["count_stuck"] = _adaptor_classmethod(self.count_stuck)
+        return class_methods
+
+    def count_by_state(self, documents):
+        """Count ``documents`` per declared state in a single pass.
+
+        Documents in states the machine does not declare are not counted.
+        """
+        return self.declared_counts(
+            collections.Counter(map(operator.attrgetter("aasm_state"), documents))
+        )
+
+    def declared_counts(self, counts):
+        return dict(
+            (state_name, counts.get(state_name, 0)) for state_name in self.states
+        )
+
+    def count_by_event(self, documents):
+        """Count ``documents`` per event they can currently fire."""
+        return self.count_events(self.count_by_state(documents))
+
+    def count_stuck(self, documents, older_than, now=None):
+        """Count ``documents`` per state they entered more than ``older_than`` ago.
+
+        ``older_than`` is in seconds or a ``timedelta``.
+        """
+        if isinstance(older_than, datetime.timedelta):
+            older_than = older_than.total_seconds()
+        if now is None:
+            now = self.state_changed_now()
+        cutoff = now - older_than
+        return self.declared_counts(
+            collections.Counter(
+                document.aasm_state
+                for document in documents
+                if document.state_changed_at is not None
+                and document.state_changed_at <= cutoff
+            )
+        )
+
+    def count_events(self, state_counts):
+        counts = dict.fromkeys(self.events, 0)
+        for state_name, count in six.iteritems(state_counts):
+            for event_name in self.events_by_state.get(state_name, ()):
+                counts[event_name] += count
+        return counts
+
     def extra_class_members(self, initial_state):
         raise NotImplementedError
 
     def update(self, document, state_name):
         raise NotImplementedError
+
+    def transition(self, document, from_state_name, to_state_name):
+        """Move ``document`` from the state the event checked to its target.
+
+        Adaptors whose store can change under the event (another process)
+        override this to write only if the state is still ``from_state_name``
+        and raise :class:`InvalidStateTransition` otherwise.
+        """
+        self.update(document, to_state_name)
@@ -0,0 +1,127 @@
+from __future__ import absolute_import
+
+import collections
+
+import six
+
+from statu.models import InvalidStateTransition
+
+
+def compile_event_method(adaptor, document_class, event_name, fallback):
+    """Generate an event method specialised for ``document_class``.
+
+    Source states are tested against literals, callbacks are unrolled into
+    direct calls on closure variables and, for adaptors whose ``update`` is a
+    plain assignment, the state is written inline. With locking, only the
+    state check, before callbacks and update run under the lock. Instances of
+    other classes (subclasses with their own callbacks) go through
+    ``fallback``.
+    """
+    table = adaptor.callback_tables.get(document_class)
+    if table is None:
+        table = adaptor.build_callback_table(document_class)
+
+    # from states sharing the same callbacks share a branch
+    branches_by_callbacks = collections.OrderedDict()
+    for from_name, callbacks in six.iteritems(table[event_name]):
+        branches_by_callbacks.setdefault(callbacks, []).append(from_name)
+
+    closure = {
+        "InvalidStateTransition": InvalidStateTransition,
+        "_document_class": document_class,
+        "_fallback": fallback,
+    }
+    if not adaptor.plain_update:
+        closure["_transition"] = adaptor.transition
+    branches = []
+    for index, ((before, after), from_names) in enumerate(
+        six.iteritems(branches_by_callbacks)
+    ):
+        if len(from_names) == 1:
+            condition = "state == {!r}".format(from_names[0])
+        else:
+            closure["_from_{}".format(index)] = frozenset(from_names)
+            condition = "state in _from_{}".format(index)
+        transition_lines = []
+        for position, callback in enumerate(before):
+            name = "_before_{}_{}".format(index, position)
+            closure[name] = callback
+            transition_lines.extend(
+                [
+                    "if {}(self) is False:".format(name),
+                    "    print(\"One of the 'before' callbacks returned false, breaking\")",
+                    "    return False",
+                ]
+            )
+        transition_lines.extend(_update_lines(adaptor, event_name))
+        after_lines = []
+        for position, callback in enumerate(after):
+            name = "_after_{}_{}".format(index, position)
+            closure[name] = callback
+            after_lines.append("{}(self)".format(name))
+        branches.append((condition, transition_lines, after_lines))
+
+    body = [
+        "if self.__class__ is not _document_class:",
+        "    return _fallback(self)",
+    ]
+    if adaptor.lock_for is None:
+        body.append("state = self.aasm_state")
+        for condition, transition_lines, after_lines in branches:
+            body.append("if {}:".format(condition))
+            body.extend(_indent(transition_lines + after_lines + ["return True"]))
+        body.append("raise InvalidStateTransition")
+    else:
+        # only the check, before callbacks and update run under the lock
+        closure["_lock_for"] = adaptor.lock_for
+        checks = ["state = self.aasm_state"]
+        for index, (condition, transition_lines, _after_lines) in enumerate(branches):
+            checks.append("{} {}:".format("elif" if index else "if", condition))
+            checks.extend(_indent(transition_lines + ["branch = {}".format(index)]))
+        checks.extend(["else:", "    raise InvalidStateTransition"])
+        body.extend(
+            ["lock = _lock_for(self)", "lock.acquire()", "try:"]
+            + _indent(checks)
+            + ["finally:", "    lock.release()"]
+        )
+        for index, (_condition, _transition_lines, after_lines) in enumerate(branches):
+            if after_lines:
+                body.append("if branch == {}:".format(index))
+                body.extend(_indent(after_lines))
+        body.append("return True")
+
+    names = sorted(closure)
+    source = "\n".join(
+        [
+            "def _make({}):".format(", ".join(names)),
+            "    def {}(self):".format(event_name),
+        ]
+        + ["        " + line for line in body]
+        + ["    return {}".format(event_name)]
+    )
+    filename = "<statu {}.{}>".format(document_class.__name__, event_name)
+    namespace = {}
+    six.exec_(compile(source, filename, "exec"), namespace)
+    method = namespace["_make"](**closure)
+    method.__module__ = document_class.__module__
+    return method
+
+
+def _indent(lines):
+    return ["    " + line for line in lines]
+
+
+def _update_lines(adaptor, event_name):
+    to_state_name = adaptor.events[event_name].to_state.name
+    if adaptor.plain_update:
+        lines = ["self.aasm_state = {!r}".format(to_state_name)]
+    else:
+        lines = ["_transition(self, state, {!r})".format(to_state_name)]
+    if adaptor.state_timeouts:
+        lines.extend(
+            [
+                "if self._timeout_scheduler is not None:",
+                "    self._timeout_scheduler.state_changed(self)",
+            ]
+        )
+    return lines
@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+
+import contextlib
+import threading
+
+from statu.orm.base import BaseAdaptor
+
+
+class LocalPipeline(object):
+    def __init__(self, store):
+        self.store = store
+        self.commands = []
+
+    def get(self, key):
+        self.commands.append((self.store.get, (key,)))
+        return self
+
+    def set(self, key, value):
+        self.commands.append((self.store.set, (key, value)))
+        return self
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [command(*args) for command, args in commands]
+
+
+class LocalStore(object):
+    """In-process stand-in for a redis-like client, for tests and single processes.
+
+    Implements the subset of the redis-py API used by :class:`KeyValueAdaptor`:
+    ``get``, ``set`` and ``pipeline``.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+        return True
+
+    def pipeline(self):
+        return LocalPipeline(self)
+
+
+class KeyValueAdaptor(BaseAdaptor):
+    """Keeps the state of each object under ``<ClassName>:<key>`` in a key-value store.
+
+    Opt in by setting ``__state_store__`` on the class to a redis-like client
+    (or a :class:`LocalStore`); ``__state_key__`` names the attribute holding
+    the object key and defaults to ``id``. Reads happen through
+    ``load_states`` and writes go through immediately, or are pipelined when
+    made inside a ``state_batch()`` block.
+    """
+
+    def __init__(self, original_class, batch_size=1000, **options):
+        super(KeyValueAdaptor, self).__init__(original_class, **options)
+        self.store = original_class.__state_store__
+        self.key_attribute = getattr(original_class, "__state_key__", "id")
+        self.prefix = original_class.__name__
+        self.batch_size = batch_size
+        self._local = threading.local()
+
+    def key(self, document):
+        return "{}:{}".format(self.prefix, getattr(document, self.key_attribute))
+
+    def extra_class_members(self, initial_state):
+        adaptor = self
+
+        def load_states(cls, documents):
+            adaptor.load(documents)
+            return documents
+
+        def state_batch(cls):
+            return adaptor.batch()
+
+        return {
+            "aasm_state": initial_state.name,
+            "load_states": classmethod(load_states),
+            "state_batch": classmethod(state_batch),
+        }
+
+    def update(self, document, state_name):
+        document.aasm_state = state_name
+        self.record_state_change(document)
+        pending = getattr(self._local, "pending", None)
+        if pending is None:
+            self.store.set(self.key(document), state_name)
+        else:
+            pending[self.key(document)] = state_name
+
+    def load(self, documents):
+        """Fetch the stored state of ``documents``, one pipeline per batch."""
+        documents = list(documents)
+        for start in range(0, len(documents), self.batch_size):
+            chunk = documents[start : start + self.batch_size]
+            pipeline = self.store.pipeline()
+            for document in chunk:
+                pipeline.get(self.key(document))
+            for document, state_name in zip(chunk, pipeline.execute()):
+                if state_name is not None:
+                    if isinstance(state_name, bytes):
+                        state_name = state_name.decode("utf-8")
+                    document.aasm_state = state_name
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Buffer writes made inside the block and pipeline them on exit.
+
+        The writes are flushed even if the block raises, since the objects
+        already hold their new states.
+        """
+        if getattr(self._local, "pending", None) is not None:
+            yield
+            return
+        self._local.pending = {}
+        try:
+            yield
+        finally:
+            try:
+                self.flush()
+            finally:
+                self._local.pending = None
+
+    def flush(self, documents=None):
+        pending = getattr(self._local, "pending", None)
+        if not pending:
+            return
+        items = list(pending.items())
+        pending.clear()
+        for start in range(0, len(items), self.batch_size):
+            pipeline = self.store.pipeline()
+            for key, state_name in items[start : start + self.batch_size]:
+                pipeline.set(key, state_name)
+            pipeline.execute()
+
+
+def get_keyvalue_adaptor(original_class, **options):
+    if getattr(original_class, "__state_store__", None) is not None:
+        return KeyValueAdaptor(original_class, **options)
+    return None
@@ -0,0 +1,124 @@
+from __future__ import absolute_import
+
+from statu.models import InvalidStateTransition
+from statu.orm.base import BaseAdaptor
+
+_CODE_FORMAT = "I"
+_CODE_SIZE = 4
+
+
+class SharedStateArray(object):
+    """Integer state codes for ``size`` object slots in shared memory.
+
+    Create it before the worker processes fork (or pass it to them as a
+    ``Process`` argument) so they share both the memory and the lock
+    stripes. Every slot starts at code 0. Reads are plain loads from the
+    shared buffer; writes hold the lock stripe of their slot.
+
+    Requires Python 3.8+ for :mod:`multiprocessing.shared_memory`.
+    """
+
+    def __init__(self, size, stripes=64, context=None):
+        # multiprocessing is only imported once shared state is used
+        import multiprocessing
+        from multiprocessing import shared_memory
+
+        if context is None:
+            context = multiprocessing
+        nbytes = size * _CODE_SIZE
+        self.size = size
+        self.memory = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.memory.buf[:nbytes] = bytes(nbytes)
+        self.codes = self.memory.buf[:nbytes].cast(_CODE_FORMAT)
+        self.locks = [context.Lock() for _ in range(stripes)]
+
+    def __getstate__(self):
+        return self.memory.name, self.size, self.locks
+
+    def __setstate__(self, state):
+        from multiprocessing import shared_memory
+
+        name, self.size, self.locks = state
+        self.memory = shared_memory.SharedMemory(name=name)
+        self.codes = self.memory.buf[: self.size * _CODE_SIZE].cast(_CODE_FORMAT)
+
+    def __len__(self):
+        return self.size
+
+    def get(self, slot):
+        return self.codes[slot]
+
+    def set(self, slot, code):
+        with self.locks[slot % len(self.locks)]:
+            self.codes[slot] = code
+
+    def compare_and_swap(self, slot, expected, code):
+        """Set ``slot`` to ``code`` if it still holds ``expected``; return whether it did."""
+        with self.locks[slot % len(self.locks)]:
+            if self.codes[slot] != expected:
+                return False
+            self.codes[slot] = code
+            return True
+
+    def close(self):
+        self.codes.release()
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
+
+
+class SharedStateAdaptor(BaseAdaptor):
+    """Keeps the state of each object as an integer code in a :class:`SharedStateArray`.
+
+    Opt in by setting ``__state_store__`` on the class to a
+    :class:`SharedStateArray`; ``__state_slot__`` names the attribute holding
+    the object's slot and defaults to ``slot``. Code 0 is the initial state,
+    so fresh slots start there. ``aasm_state`` reads the shared code without
+    locking, and transitions compare and swap it, so an event that loses a
+    race with another process raises :class:`InvalidStateTransition`.
+    """
+
+    def __init__(self, original_class, **options):
+        super(SharedStateAdaptor, self).__init__(original_class, **options)
+        self.array = original_class.__state_store__
+        self.slot_attribute = getattr(original_class, "__state_slot__", "slot")
+        self.state_names = []
+        self.state_codes = {}
+
+    def extra_class_members(self, initial_state):
+        self.state_names = [initial_state.name] + [
+            state_name for state_name in self.states if state_name != initial_state.name
+        ]
+        self.state_codes = dict(
+            (state_name, code) for code, state_name in enumerate(self.state_names)
+        )
+        state_names = self.state_names
+        codes = self.array.codes
+        slot_attribute = self.slot_attribute
+
+        def aasm_state(self):
+            return state_names[codes[getattr(self, slot_attribute)]]
+
+        return {"aasm_state": property(aasm_state)}
+
+    def update(self, document, state_name):
+        self.array.set(
+            getattr(document, self.slot_attribute), self.state_codes[state_name]
+        )
+        self.record_state_change(document)
+
+    def transition(self, document, from_state_name, to_state_name):
+        if not self.array.compare_and_swap(
+            getattr(document, self.slot_attribute),
+            self.state_codes[from_state_name],
+            self.state_codes[to_state_name],
+        ):
+            raise InvalidStateTransition
+        self.record_state_change(document)
+
+
+def get_shared_state_adaptor(original_class, **options):
+    if isinstance(getattr(original_class, "__state_store__", None), SharedStateArray):
+        return SharedStateAdaptor(original_class, **options)
+    return None
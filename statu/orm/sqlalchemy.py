@@ -1,32 +1,406 @@
 from __future__ import absolute_import
 
-from sqlalchemy.ext.hybrid import hybrid_property
+import collections
+import datetime
+
+import six
 
 try:
     import sqlalchemy
     from sqlalchemy import inspection, event
+    from sqlalchemy.ext.hybrid import hybrid_property
     from sqlalchemy.orm import instrumentation
     from sqlalchemy.orm import Session
 except ImportError:
     sqlalchemy = None
+    hybrid_property = None
     instrumentation = None
+    Session = None
+
+from statu.cache import StateCache
+from statu.orm.base import (
+    BaseAdaptor,
+    _adaptor_classmethod,
+    _get_next_event_methods,
+    _get_next_event_names,
+)
+
+_DEFERRED_KEY = "statu_deferred_callbacks"
+_CACHE_DIRTY_KEY = "statu_cache_dirty"
+_CACHE_FLUSHED_KEY = "statu_cache_flushed"
+
+
+def _ends_outermost_transaction(session):
+    # in after_commit and after_rollback, session.transaction is the one ending
+    transaction = session.transaction
+    return transaction is None or transaction.parent is None
+
+
+def _real_transaction(transaction):
+    # subtransactions commit and roll back with their enclosing transaction
+    while (
+        transaction is not None
+        and transaction.parent is not None
+        and not transaction.nested
+    ):
+        transaction = transaction.parent
+    return transaction
+
+
+def _deferred_queue(session):
+    queues = session.info.setdefault(_DEFERRED_KEY, {})
+    transaction = _real_transaction(session.transaction)
+    return queues.setdefault(transaction, collections.OrderedDict())
+
+
+def _run_deferred_callbacks(session):
+    queues = session.info.get(_DEFERRED_KEY)
+    if not queues:
+        return
+    transaction = session.transaction
+    deferred = queues.pop(transaction, None)
+    if not _ends_outermost_transaction(session):
+        # a savepoint committed: its callbacks wait for the enclosing transaction
+        if deferred:
+            queue = queues.setdefault(
+                _real_transaction(transaction.parent), collections.OrderedDict()
+            )
+            for key, (callbacks, batch_callbacks, documents) in six.iteritems(deferred):
+                if key in queue:
+                    queue[key][2].extend(documents)
+                else:
+                    queue[key] = (callbacks, batch_callbacks, documents)
+        return
+    session.info.pop(_DEFERRED_KEY, None)
+    if not deferred:
+        return
+    for (document_class, _event_name), batch in six.iteritems(deferred):
+        callbacks, batch_callbacks, documents = batch
+        for document in documents:
+            for callback in callbacks:
+                callback(document)
+        for batch_callback in batch_callbacks:
+            batch_callback(document_class, documents)
+
 
-from statu.orm.base import BaseAdaptor, _get_next_event_methods, _get_next_event_names
+def _discard_deferred_callbacks(session):
+    if _ends_outermost_transaction(session):
+        session.info.pop(_DEFERRED_KEY, None)
+    elif session.info.get(_DEFERRED_KEY):
+        # only what the rolled back savepoint queued
+        session.info[_DEFERRED_KEY].pop(session.transaction, None)
+
+
+def _invalidate_flushed_states(session, _flush_context):
+    dirty = session.info.pop(_CACHE_DIRTY_KEY, None)
+    if not dirty:
+        return
+    flushed = session.info.setdefault(_CACHE_FLUSHED_KEY, {})
+    for adaptor, document in six.itervalues(dirty):
+        key = adaptor.identity(document)
+        if key is not None:
+            adaptor.state_cache.invalidate(key)
+            flushed[(adaptor, key)] = document.aasm_state
+
+
+def _cache_committed_states(session):
+    if not _ends_outermost_transaction(session):
+        # a savepoint: the outer transaction can still roll back
+        return
+    session.info.pop(_CACHE_DIRTY_KEY, None)
+    flushed = session.info.pop(_CACHE_FLUSHED_KEY, None)
+    if flushed:
+        for (adaptor, key), state_name in six.iteritems(flushed):
+            if state_name is None:
+                adaptor.state_cache.invalidate(key)
+            else:
+                adaptor.state_cache.set(key, state_name)
+
+
+def _invalidate_rolled_back_states(session):
+    if not _ends_outermost_transaction(session):
+        # states flushed so far may have been undone by the savepoint, so
+        # they are only invalidated on commit
+        flushed = session.info.get(_CACHE_FLUSHED_KEY)
+        if flushed:
+            for entry in flushed:
+                flushed[entry] = None
+        return
+    session.info.pop(_CACHE_DIRTY_KEY, None)
+    flushed = session.info.pop(_CACHE_FLUSHED_KEY, None)
+    if flushed:
+        for adaptor, key in flushed:
+            adaptor.state_cache.invalidate(key)
+
+
+_installed_listeners = set()
+
+
+def _listen_once(target, identifier, fn):
+    if (target, identifier, fn) not in _installed_listeners:
+        event.listen(target, identifier, fn)
+        _installed_listeners.add((target, identifier, fn))
 
 
 class SqlAlchemyAdaptor(BaseAdaptor):
     property_type = hybrid_property
 
+    def __init__(
+        self, original_class, defer_after_callbacks=False, state_cache=None, **options
+    ):
+        super(SqlAlchemyAdaptor, self).__init__(original_class, **options)
+        self.defer_after_callbacks = defer_after_callbacks
+        if defer_after_callbacks:
+            _listen_once(Session, "after_commit", _run_deferred_callbacks)
+            _listen_once(Session, "after_rollback", _discard_deferred_callbacks)
+        if state_cache is True:
+            state_cache = StateCache()
+        self.state_cache = state_cache
+        if state_cache is not None:
+            _listen_once(Session, "after_flush", _invalidate_flushed_states)
+            _listen_once(Session, "after_commit", _cache_committed_states)
+            _listen_once(Session, "after_rollback", _invalidate_rolled_back_states)
+
+    def after_callbacks(self, document_class, event_name, callbacks, batch_callbacks):
+        if not self.defer_after_callbacks:
+            return super(SqlAlchemyAdaptor, self).after_callbacks(
+                document_class, event_name, callbacks, batch_callbacks
+            )
+        if not callbacks and not batch_callbacks:
+            return ()
+        key = (document_class, event_name)
+        callbacks = tuple(callbacks)
+        batch_callbacks = tuple(batch_callbacks)
+
+        def defer(document):
+            session = sqlalchemy.orm.object_session(document)
+            if session is None:
+                # nothing to wait for
+                for callback in callbacks:
+                    callback(document)
+                for batch_callback in batch_callbacks:
+                    batch_callback(document_class, [document])
+                return
+            deferred = _deferred_queue(session)
+            if key not in deferred:
+                deferred[key] = (callbacks, batch_callbacks, [])
+            deferred[key][2].append(document)
+
+        return (defer,)
+
+    @property
+    def plain_update(self):
+        return self.state_cache is None and not self.track_state_changes
+
+    def state_changed_now(self):
+        return datetime.datetime.utcnow()
+
+    def time_in_state(self, document):
+        changed_at = document.state_changed_at
+        if changed_at is None:
+            return None
+        return (self.state_changed_now() - changed_at).total_seconds()
+
+    def changed_at_column(self, changed_at):
+        if changed_at is not None:
+            return changed_at
+        if not self.track_state_changes:
+            raise ValueError(
+                "changed_at is required unless track_state_changes is enabled"
+            )
+        return self.original_class.state_changed_at
+
     def extra_class_members(self, initial_state):
         return {}
 
+    def class_methods(self):
+        class_methods = super(SqlAlchemyAdaptor, self).class_methods()
+        class_methods.update(
+            {
+                "available_events": _adaptor_classmethod(self.available_events),
+                "count_stuck": _adaptor_classmethod(self.count_stuck),
+                "get_states": _adaptor_classmethod(self.get_states),
+                "sweep_timeouts": _adaptor_classmethod(self.sweep_timeouts),
+            }
+        )
+        return class_methods
+
+    def flush(self, documents):
+        sessions = set()
+        for document in documents:
+            session = sqlalchemy.orm.object_session(document)
+            if session is not None and session not in sessions:
+                sessions.add(session)
+                session.flush()
+
+    def query(self, source):
+        if isinstance(source, Session):
+            return source.query(self.original_class)
+        return source
+
+    def count_by_state(self, source):
+        """Count rows per declared state with one ``GROUP BY`` query.
+
+        ``source`` is a session or a query over the model. Rows in states the
+        machine does not declare (or with no state) are not counted.
+        """
+        model = self.original_class
+        rows = (
+            self.query(source)
+            .filter(model.aasm_state.in_(self.states))
+            .with_entities(model.aasm_state, sqlalchemy.func.count())
+            .group_by(model.aasm_state)
+        )
+        return self.declared_counts(dict(rows))
+
+    def count_by_event(self, source):
+        """Count rows per event they can currently fire, from one query."""
+        return self.count_events(self.count_by_state(source))
+
+    def available_events(self, source, ids=None):
+        """Map the primary key of each row to the events it can currently fire.
+
+        ``source`` is a session or a query over the model; only primary keys
+        and states are fetched. With ``ids``, ``source`` is a session and the
+        states come from :meth:`get_states`, so cached states are not queried.
+        """
+        if ids is not None:
+            rows = six.iteritems(self.get_states(source, ids))
+        else:
+            rows = self.identity_rows(self.query(source))
+        events_by_state = self.events_by_state
+        return collections.OrderedDict(
+            (key, list(events_by_state.get(state_name, ()))) for key, state_name in rows
+        )
+
+    def count_stuck(self, source, older_than, changed_at=None, now=None):
+        """Count rows per state that entered it more than ``older_than`` ago.
+
+        ``older_than`` is in seconds or a ``timedelta``; ``changed_at`` is the
+        column recording when a row entered its state and defaults to the
+        tracked ``state_changed_at`` column.
+        """
+        model = self.original_class
+        changed_at = self.changed_at_column(changed_at)
+        if not isinstance(older_than, datetime.timedelta):
+            older_than = datetime.timedelta(seconds=older_than)
+        if now is None:
+            now = datetime.datetime.utcnow()
+        rows = (
+            self.query(source)
+            # the state predicate lets (aasm_state, changed_at) be range scanned
+            .filter(model.aasm_state.in_(self.states), changed_at <= now - older_than)
+            .with_entities(model.aasm_state, sqlalchemy.func.count())
+            .group_by(model.aasm_state)
+        )
+        return self.declared_counts(dict(rows))
+
     def update(self, document, state_name):
         document.aasm_state = state_name
+        self.record_state_change(document)
+        if self.state_cache is not None:
+            key = self.identity(document)
+            if key is not None:
+                self.state_cache.invalidate(key)
+            session = sqlalchemy.orm.object_session(document)
+            if session is not None:
+                dirty = session.info.setdefault(_CACHE_DIRTY_KEY, {})
+                dirty[id(document)] = (self, document)
+
+    def identity(self, document):
+        """The primary key of ``document``, a tuple for composite keys."""
+        identity = sqlalchemy.inspect(document).identity
+        if identity is None or len(identity) > 1:
+            return identity
+        return identity[0]
+
+    def identity_rows(self, query):
+        """Yield ``(identity, state_name)`` pairs, fetching only those columns."""
+        model = self.original_class
+        primary_key = tuple(sqlalchemy.inspect(model).primary_key)
+        rows = query.with_entities(*(primary_key + (model.aasm_state,)))
+        if len(primary_key) == 1:
+            return iter(rows)
+        return ((tuple(row[:-1]), row[-1]) for row in rows)
+
+    def get_states(self, session, ids):
+        """Map each of ``ids`` to its state name, querying only the cache misses.
+
+        Ids of models with a composite primary key are tuples. Ids without a
+        row are left out of the result.
+        """
+        model = self.original_class
+        states = {}
+        misses = []
+        for key in ids:
+            state_name = None
+            if self.state_cache is not None:
+                state_name = self.state_cache.get(key)
+            if state_name is None:
+                misses.append(key)
+            else:
+                states[key] = state_name
+        if misses:
+            primary_key = sqlalchemy.inspect(model).primary_key
+            if len(primary_key) == 1:
+                criterion = primary_key[0].in_(misses)
+            else:
+                criterion = sqlalchemy.tuple_(*primary_key).in_(misses)
+            rows = self.identity_rows(session.query(model).filter(criterion))
+            for key, state_name in rows:
+                states[key] = state_name
+                if self.state_cache is not None:
+                    self.state_cache.set(key, state_name)
+        return states
+
+    def cache_loaded_state(self, document, _context, attrs=None):
+        if attrs is not None and "aasm_state" not in attrs:
+            return
+        key = self.identity(document)
+        session = sqlalchemy.orm.object_session(document)
+        if session is not None and (self, key) in session.info.get(
+            _CACHE_FLUSHED_KEY, ()
+        ):
+            # the row holds uncommitted changes
+            return
+        self.state_cache.set(key, document.aasm_state)
+
+    def sweep_timeouts(self, session, changed_at=None, now=None):
+        """Move every overdue row out of its timed state.
+
+        Issues one set-based UPDATE per timed state, comparing ``changed_at``
+        (the column recording when a row entered its state, by default the
+        tracked ``state_changed_at`` column) against the state's timeout.
+        Callbacks are not run for swept rows. Returns the number of rows swept
+        per state name.
+        """
+        model = self.original_class
+        changed_at = self.changed_at_column(changed_at)
+        if now is None:
+            now = datetime.datetime.utcnow()
+        swept = {}
+        for state_name, (seconds, event_name) in six.iteritems(self.state_timeouts):
+            cutoff = now - datetime.timedelta(seconds=seconds)
+            swept[state_name] = (
+                session.query(model)
+                .filter(model.aasm_state == state_name, changed_at <= cutoff)
+                .update(
+                    {
+                        model.aasm_state: self.events[event_name].to_state.name,
+                        changed_at: now,
+                    },
+                    synchronize_session=False,
+                )
+            )
+        if self.state_cache is not None and any(six.itervalues(swept)):
+            self.state_cache.clear()
+        return swept
 
     def modifed_class(self, original_class, callback_cache):
         class_dict = dict()
 
         class_dict["callback_cache"] = callback_cache
+        setattr(original_class, "callback_cache", callback_cache)
 
         def current_state_method():
             def f(self):
@@ -37,7 +411,29 @@ class SqlAlchemyAdaptor(BaseAdaptor):
         setattr(original_class, "current_state", current_state_method())
         setattr(original_class, "get_next_event_names", _get_next_event_names)
         setattr(original_class, "get_next_event_methods", _get_next_event_methods)
+        setattr(original_class, "_state_adaptor", self)
         setattr(original_class, "aasm_state", sqlalchemy.Column(sqlalchemy.String))
+        if self.track_state_changes:
+            setattr(
+                original_class,
+                "state_changed_at",
+                sqlalchemy.Column(sqlalchemy.DateTime),
+            )
+            setattr(original_class, "time_in_state", property(self.time_in_state))
+            # "stuck in state X for longer than Y" becomes an index range scan
+            table = original_class.__table__
+            sqlalchemy.Index(
+                "ix_{}_aasm_state_changed_at".format(table.name),
+                table.c.aasm_state,
+                table.c.state_changed_at,
+            )
+
+        for key, value in six.iteritems(self.class_methods()):
+            setattr(original_class, key, value)
+
+        if self.state_cache is not None:
+            event.listen(original_class, "load", self.cache_loaded_state)
+            event.listen(original_class, "refresh", self.cache_loaded_state)
 
         @event.listens_for(sqlalchemy.orm.mapper, "after_configured", once=True)
         def adapt():
@@ -49,6 +445,8 @@ class SqlAlchemyAdaptor(BaseAdaptor):
             @event.listens_for(original_class, "init", propagate=True)
             def class_init_aasm_state(target, _args, _kwargs):
                 target.aasm_state = initial_state.name
+                if self.track_state_changes:
+                    target.state_changed_at = self.state_changed_now()
 
             # Get events
             event_method_dict = self.process_events(original_class)
@@ -60,11 +458,11 @@ class SqlAlchemyAdaptor(BaseAdaptor):
         return original_class
 
 
-def get_sqlalchemy_adaptor(original_class):
+def get_sqlalchemy_adaptor(original_class, **options):
     if (
         sqlalchemy is not None
         and hasattr(original_class, "_sa_class_manager")
         and isinstance(original_class._sa_class_manager, instrumentation.ClassManager)
     ):
-        return SqlAlchemyAdaptor(original_class)
+        return SqlAlchemyAdaptor(original_class, **options)
     return None
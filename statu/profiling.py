@@ -0,0 +1,118 @@
+from __future__ import absolute_import
+
+import collections
+import contextlib
+import functools
+import threading
+import time
+
+from statu.orm import base
+
+try:
+    _perf_counter = time.perf_counter
+except AttributeError:
+    _perf_counter = time.time
+
+CallbackStats = collections.namedtuple(
+    "CallbackStats", ["document_class", "event", "callback", "calls", "total", "max"]
+)
+
+
+class CallbackProfiler(object):
+    """Times every callback fired by state machine events.
+
+    Timings are aggregated by (class name, event name, callback qualname).
+    """
+
+    def __init__(self, timer=_perf_counter):
+        self.timer = timer
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def wrap(self, document_class, event_name, callback):
+        key = (
+            document_class.__name__,
+            event_name,
+            getattr(callback, "__qualname__", repr(callback)),
+        )
+        timer = self.timer
+        record = self.record
+
+        @functools.wraps(callback)
+        def timed(*args):
+            start = timer()
+            try:
+                return callback(*args)
+            finally:
+                record(key, timer() - start)
+
+        return timed
+
+    def record(self, key, elapsed):
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                self._stats[key] = [1, elapsed, elapsed]
+            else:
+                stats[0] += 1
+                stats[1] += elapsed
+                if elapsed > stats[2]:
+                    stats[2] = elapsed
+
+    def report(self, top=None):
+        """Return :class:`CallbackStats` sorted by total time, slowest first."""
+        with self._lock:
+            stats = [
+                CallbackStats(*(key + tuple(values)))
+                for key, values in self._stats.items()
+            ]
+        stats.sort(key=lambda entry: entry.total, reverse=True)
+        return stats[:top] if top is not None else stats
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+_profiler = None
+
+
+def enable(profiler=None):
+    """Start timing callbacks; returns the active :class:`CallbackProfiler`."""
+    global _profiler
+    _profiler = profiler if profiler is not None else CallbackProfiler()
+    base.set_callback_wrapper(_profiler.wrap)
+    return _profiler
+
+
+def disable():
+    """Stop timing callbacks; the event path goes back to calling them directly."""
+    global _profiler
+    _profiler = None
+    base.set_callback_wrapper(None)
+
+
+def is_enabled():
+    return _profiler is not None
+
+
+def report(top=None):
+    return _profiler.report(top) if _profiler is not None else []
+
+
+@contextlib.contextmanager
+def profile():
+    """Collect callback timings for the duration of the block.
+
+    Yields the :class:`CallbackProfiler`; the previously active profiler, if
+    any, is restored on exit.
+    """
+    previous = _profiler
+    profiler = enable()
+    try:
+        yield profiler
+    finally:
+        if previous is not None:
+            enable(previous)
+        else:
+            disable()
@@ -0,0 +1,266 @@
+from __future__ import absolute_import
+
+import bisect
+import collections
+import math
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from statu.machine import MachineDescriptor, describe_machine
+
+
+class SimulationResult(
+    collections.namedtuple(
+        "SimulationResult",
+        [
+            "states",
+            "times",
+            "occupancy",
+            "bin_edges",
+            "time_in_state",
+            "transitions",
+            "final",
+        ],
+    )
+):
+    """Outcome of :func:`simulate`.
+
+    ``occupancy`` maps each state to the number of instances in it at each of
+    ``times``; ``time_in_state`` maps each state to a :class:`DwellStats` over
+    the completed stays (stays cut off by the end of the run are not counted);
+    ``final`` maps each state to its occupancy at the end of the run.
+    """
+
+    __slots__ = ()
+
+
+DwellStats = collections.namedtuple("DwellStats", ["count", "mean", "histogram"])
+
+
+def simulate(
+    machine,
+    rates,
+    instances=10000,
+    duration=100.0,
+    samples=100,
+    bins=50,
+    seed=None,
+    use_numpy=None,
+    time_unit=1.0,
+):
+    """Run a discrete-event simulation of ``instances`` independent machines.
+
+    ``machine`` is a decorated class or its :class:`MachineDescriptor`;
+    ``rates`` maps event names to the rate (per unit of time) at which each
+    instance fires the event while it is available. Competing events race,
+    so the relative rates of the events leaving a state are their
+    probabilities. Every instance starts in the initial state at time 0 and
+    runs until ``duration``.
+
+    Timed states fire their timeout event once an instance has stayed in
+    them for their timeout, unless another event fired first.
+    ``time_unit`` is the number of seconds in one unit of simulated time,
+    used to convert the timeouts.
+
+    With numpy available all instances advance in lockstep over array-backed
+    state, which handles tens of millions of transitions per run; otherwise
+    a pure Python loop is used.
+    """
+    if not isinstance(machine, MachineDescriptor):
+        machine = describe_machine(machine)
+    unknown = set(rates) - set(name for name, _from, _to in machine.events)
+    if unknown:
+        raise ValueError("unknown events: {}".format(", ".join(sorted(unknown))))
+
+    index = dict((state_name, i) for i, state_name in enumerate(machine.states))
+    exits = [[] for _ in machine.states]
+    for event_name, from_states, to_state in machine.events:
+        rate = rates.get(event_name, 0)
+        if rate < 0:
+            raise ValueError("negative rate for {!r}".format(event_name))
+        if rate:
+            for from_state in from_states:
+                exits[index[from_state]].append((rate, index[to_state]))
+
+    timeouts = [None] * len(machine.states)
+    to_states = dict((name, to_state) for name, _from, to_state in machine.events)
+    for state_name, seconds, event_name in machine.timeouts:
+        timeouts[index[state_name]] = (
+            float(seconds) / time_unit,
+            index[to_states[event_name]],
+        )
+
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    run = _simulate_numpy if use_numpy else _simulate_python
+    occupancy, histogram, dwell_total, transitions, final = run(
+        exits,
+        timeouts,
+        index[machine.initial],
+        instances,
+        duration,
+        samples,
+        bins,
+        seed,
+    )
+
+    time_in_state = {}
+    for i, state_name in enumerate(machine.states):
+        count = sum(histogram[i])
+        mean = dwell_total[i] / count if count else None
+        time_in_state[state_name] = DwellStats(count, mean, tuple(histogram[i]))
+    return SimulationResult(
+        states=machine.states,
+        times=tuple(k * duration / samples for k in range(samples)),
+        occupancy=dict(
+            (state_name, tuple(occupancy[i]))
+            for i, state_name in enumerate(machine.states)
+        ),
+        bin_edges=tuple(k * duration / bins for k in range(bins + 1)),
+        time_in_state=time_in_state,
+        transitions=transitions,
+        final=dict(
+            (state_name, final[i]) for i, state_name in enumerate(machine.states)
+        ),
+    )
+
+
+def _simulate_python(
+    exits, timeouts, initial, instances, duration, samples, bins, seed
+):
+    rng = random.Random(seed)
+    n_states = len(exits)
+    total_rates = [sum(rate for rate, _target in state_exits) for state_exits in exits]
+    cumulative = []
+    for state_exits in exits:
+        running, bounds = 0.0, []
+        for rate, _target in state_exits:
+            running += rate
+            bounds.append(running)
+        cumulative.append(bounds)
+    targets = [[target for _rate, target in state_exits] for state_exits in exits]
+
+    sample_width = float(duration) / samples
+    bin_width = float(duration) / bins
+    # occupancy is accumulated as a difference array over the sample grid
+    diff = [[0] * (samples + 1) for _ in range(n_states)]
+    histogram = [[0] * bins for _ in range(n_states)]
+    dwell_total = [0.0] * n_states
+    final = [0] * n_states
+    transitions = 0
+
+    for _ in range(instances):
+        state, clock = initial, 0.0
+        while True:
+            total_rate = total_rates[state]
+            leave = clock + rng.expovariate(total_rate) if total_rate else duration
+            timeout = timeouts[state]
+            expired = timeout is not None and clock + timeout[0] < leave
+            if expired:
+                leave = clock + timeout[0]
+            diff[state][int(math.ceil(clock / sample_width))] += 1
+            if leave >= duration:
+                diff[state][samples] -= 1
+                final[state] += 1
+                break
+            diff[state][min(int(math.ceil(leave / sample_width)), samples)] -= 1
+            dwell = leave - clock
+            histogram[state][min(int(dwell / bin_width), bins - 1)] += 1
+            dwell_total[state] += dwell
+            if expired:
+                state = timeout[1]
+            else:
+                choice = bisect.bisect_right(
+                    cumulative[state], rng.random() * total_rate
+                )
+                state = targets[state][min(choice, len(targets[state]) - 1)]
+            clock = leave
+            transitions += 1
+
+    occupancy = []
+    for state_diff in diff:
+        count, counts = 0, []
+        for delta in state_diff[:samples]:
+            count += delta
+            counts.append(count)
+        occupancy.append(counts)
+    return occupancy, histogram, dwell_total, transitions, final
+
+
+def _simulate_numpy(exits, timeouts, initial, instances, duration, samples, bins, seed):
+    rng = numpy.random.default_rng(seed)
+    n_states = len(exits)
+    width = max([len(state_exits) for state_exits in exits] + [1])
+    total_rates = numpy.zeros(n_states)
+    cumulative = numpy.full((n_states, width), numpy.inf)
+    targets = numpy.zeros((n_states, width), dtype=numpy.int64)
+    for i, state_exits in enumerate(exits):
+        running = 0.0
+        for j, (rate, target) in enumerate(state_exits):
+            running += rate
+            cumulative[i, j] = running
+            targets[i, j] = target
+        total_rates[i] = running
+    timeout_limits = numpy.full(n_states, numpy.inf)
+    timeout_targets = numpy.zeros(n_states, dtype=numpy.int64)
+    for i, timeout in enumerate(timeouts):
+        if timeout is not None:
+            timeout_limits[i], timeout_targets[i] = timeout
+
+    sample_width = float(duration) / samples
+    bin_width = float(duration) / bins
+    diff = numpy.zeros(n_states * (samples + 1), dtype=numpy.int64)
+    histogram = numpy.zeros(n_states * bins, dtype=numpy.int64)
+    dwell_total = numpy.zeros(n_states)
+    final = numpy.zeros(n_states, dtype=numpy.int64)
+    transitions = 0
+
+    state = numpy.full(instances, initial, dtype=numpy.int64)
+    clock = numpy.zeros(instances)
+    while state.size:
+        total_rate = total_rates[state]
+        with numpy.errstate(divide="ignore"):
+            leave = clock + rng.standard_exponential(state.size) / total_rate
+        expiry = clock + timeout_limits[state]
+        expired = expiry < leave
+        leave = numpy.where(expired, expiry, leave)
+        done = leave >= duration
+        end = numpy.where(done, duration, leave)
+
+        start_slot = numpy.ceil(clock / sample_width).astype(numpy.int64)
+        end_slot = numpy.minimum(numpy.ceil(end / sample_width), samples)
+        row = state * (samples + 1)
+        diff += numpy.bincount(row + start_slot, minlength=diff.size)
+        diff -= numpy.bincount(row + end_slot.astype(numpy.int64), minlength=diff.size)
+        final += numpy.bincount(state[done], minlength=n_states)
+
+        moving = ~done
+        state, clock, leave = state[moving], clock[moving], leave[moving]
+        expired = expired[moving]
+        dwell = leave - clock
+        slot = numpy.minimum((dwell / bin_width).astype(numpy.int64), bins - 1)
+        histogram += numpy.bincount(state * bins + slot, minlength=histogram.size)
+        dwell_total += numpy.bincount(state, weights=dwell, minlength=n_states)
+
+        draw = rng.random(state.size) * total_rates[state]
+        choice = (draw[:, None] >= cumulative[state]).sum(axis=1)
+        state = numpy.where(
+            expired,
+            timeout_targets[state],
+            targets[state, numpy.minimum(choice, width - 1)],
+        )
+        clock = leave
+        transitions += state.size
+
+    occupancy = numpy.cumsum(diff.reshape(n_states, samples + 1), axis=1)[:, :samples]
+    return (
+        occupancy.tolist(),
+        histogram.reshape(n_states, bins).tolist(),
+        dwell_total.tolist(),
+        int(transitions),
+        final.tolist(),
+    )
@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+
+import collections
+import itertools
+import sys
+
+from statu.models import InvalidStateTransition
+
+OK = "ok"
+VETOED = "vetoed"
+INVALID = "invalid"
+
+TransitionResult = collections.namedtuple(
+    "TransitionResult", ["document", "event", "status"]
+)
+
+
+def stream_transitions(items, event=None, flush_every=None):
+    """Lazily fire events over ``items``, yielding a :class:`TransitionResult` each.
+
+    ``items`` is an iterable of state machines when ``event`` names the event
+    to fire on all of them, and an iterable of ``(document, event_name)``
+    pairs otherwise. ``status`` is ``OK``, ``VETOED`` (a before callback
+    returned ``False``) or ``INVALID`` (the event cannot fire from the
+    current state); other exceptions propagate.
+
+    With ``flush_every``, writes are grouped through each adaptor's
+    ``batch()`` and persisted with ``flush()`` every ``flush_every``
+    documents, and the results of a chunk are only yielded once it is
+    persisted. Memory stays bounded by the chunk size either way.
+    """
+    if event is not None:
+        items = ((document, event) for document in items)
+
+    if not flush_every:
+        for document, event_name in items:
+            yield _fire(document, event_name)
+        return
+
+    # each chunk opens and closes its own batches, so none is held open
+    # while the consumer runs between two results
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, flush_every))
+        if not chunk:
+            return
+        for result in _fire_batched(chunk):
+            yield result
+
+
+def _fire_batched(pairs):
+    batched = collections.OrderedDict()
+    contexts = []
+    results = []
+    try:
+        for document, event_name in pairs:
+            adaptor = type(document)._state_adaptor
+            if adaptor not in batched:
+                context = adaptor.batch()
+                context.__enter__()
+                contexts.append(context)
+                batched[adaptor] = []
+            batched[adaptor].append(document)
+            results.append(_fire(document, event_name))
+    except BaseException:
+        _close_batches(batched, contexts, sys.exc_info())
+        raise
+    _close_batches(batched, contexts, (None, None, None))
+    return results
+
+
+def _close_batches(batched, contexts, exc_info):
+    try:
+        _flush(batched)
+    finally:
+        for context in reversed(contexts):
+            context.__exit__(*exc_info)
+
+
+def _fire(document, event_name):
+    try:
+        fired = getattr(document, event_name)()
+    except InvalidStateTransition:
+        return TransitionResult(document, event_name, INVALID)
+    return TransitionResult(document, event_name, OK if fired else VETOED)
+
+
+def _flush(batched):
+    for adaptor, documents in batched.items():
+        if documents:
+            adaptor.flush(documents)
+            del documents[:]
@@ -0,0 +1,171 @@
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from statu.models import InvalidStateTransition
+
+logger = logging.getLogger(__name__)
+
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    _monotonic = time.time
+
+
+class TimeoutScheduler(object):
+    """Fires the ``on_timeout`` event of timed states once their deadline passes.
+
+    Deadlines live in a min-heap. Arming pushes an entry (O(log n)); cancelling
+    marks the entry dead in O(1) and the heap is compacted once dead entries
+    outnumber live ones. Watched documents are re-armed or cancelled
+    automatically whenever one of their events changes the state.
+
+    Call :meth:`run_pending` from your own loop, or drive the scheduler with
+    :meth:`start` (background thread) or :meth:`run_async` (asyncio task).
+    """
+
+    def __init__(self, clock=_monotonic):
+        self.clock = clock
+        self._heap = []
+        self._entries = {}
+        self._dead = 0
+        self._counter = itertools.count()
+        self._condition = threading.Condition(threading.Lock())
+        self._thread = None
+        self._running = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def watch(self, document):
+        """Start tracking ``document``, arming a deadline if its state is timed."""
+        document._timeout_scheduler = self
+        self.state_changed(document)
+
+    def unwatch(self, document):
+        document._timeout_scheduler = None
+        self.cancel(document)
+
+    def cancel(self, document):
+        with self._condition:
+            self._cancel(id(document))
+
+    def state_changed(self, document):
+        # machines without timed states have no _state_timeouts
+        timeouts = getattr(document, "_state_timeouts", {})
+        timeout = timeouts.get(document.aasm_state)
+        with self._condition:
+            self._cancel(id(document))
+            if timeout is not None:
+                seconds, event_name = timeout
+                entry = [
+                    self.clock() + seconds,
+                    next(self._counter),
+                    document,
+                    document.aasm_state,
+                    event_name,
+                ]
+                self._entries[id(document)] = entry
+                heapq.heappush(self._heap, entry)
+                if self._heap[0] is entry:
+                    self._condition.notify()
+
+    def next_deadline(self):
+        with self._condition:
+            self._discard_dead_head()
+            return self._heap[0][0] if self._heap else None
+
+    def run_pending(self, now=None):
+        """Fire every expired timeout and return the documents it was fired on."""
+        if now is None:
+            now = self.clock()
+        due = []
+        with self._condition:
+            self._discard_dead_head()
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                del self._entries[id(entry[2])]
+                due.append(entry)
+                self._discard_dead_head()
+
+        fired = []
+        for _deadline, _seq, document, state_name, event_name in due:
+            if document.aasm_state != state_name:
+                continue
+            try:
+                getattr(document, event_name)()
+            except InvalidStateTransition:
+                continue
+            fired.append(document)
+        return fired
+
+    def start(self):
+        """Run the scheduler in a daemon thread until :meth:`stop` is called."""
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._running = True
+            self._thread = threading.Thread(
+                target=self._run_thread, name="statu-timeouts"
+            )
+            self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+            thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def run_async(self, poll_interval=1.0):
+        """Coroutine driving the scheduler; wrap it in ``asyncio.ensure_future``.
+
+        Requires Python 3.5+.
+        """
+        from statu._asyncio import run_scheduler
+
+        return run_scheduler(self, poll_interval)
+
+    def _run_thread(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                self._discard_dead_head()
+                if self._heap:
+                    delay = self._heap[0][0] - self.clock()
+                    if delay > 0:
+                        self._condition.wait(delay)
+                else:
+                    self._condition.wait()
+                if not self._running:
+                    return
+            self._run_pending_logged()
+
+    def _run_pending_logged(self):
+        try:
+            self.run_pending()
+        except Exception:
+            logger.exception("timeout event failed")
+
+    def _cancel(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        entry[2] = None
+        self._dead += 1
+        if self._dead > 64 and self._dead * 2 > len(self._heap):
+            self._heap = [e for e in self._heap if e[2] is not None]
+            heapq.heapify(self._heap)
+            self._dead = 0
+
+    def _discard_dead_head(self):
+        while self._heap and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+            self._dead -= 1
@@ -11,6 +11,8 @@ from statu import (
     State,
     Event,
     after,
+    on_enter,
+    on_exit,
     with_state_machine_events,
 )
 
@@ -65,6 +67,21 @@ def test_state_machine():
     assert robot.is_sleeping
 
 
+def test_current_state_object():
+    @acts_as_state_machine
+    class Robot(object):
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+    robot = Robot()
+    assert robot.current_state_object is Robot.sleeping
+    robot.run()
+    assert robot.current_state_object is Robot.running
+    assert [robot.is_sleeping, robot.is_running] == [False, True]
+
+
 def test_state_machine_no_callbacks():
     @acts_as_state_machine
     class Robot:
@@ -158,6 +175,695 @@ def test_state_machine_inheritance():
     assert things_done == ["Dog.ran", "Puppy.ran_fast", "Dog.ran"]
 
 
+def test_state_machine_extension():
+    @acts_as_state_machine
+    class Dog(object):
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        sleep = Event(from_states=(running,), to_state=sleeping)
+
+    @acts_as_state_machine
+    class GuideDog(Dog):
+        snoozing = Dog.sleeping
+        guiding = State()
+
+        guide = Event(from_states=Dog.running, to_state=guiding)
+        sleep = Event(from_states=(Dog.running, guiding), to_state=Dog.sleeping)
+
+        @after("guide")
+        def on_guide(self):
+            things_done.append("guided")
+
+    things_done = []
+    assert Dog.sleeping.name == "sleeping"
+    assert Dog._state_adaptor.states == ["running", "sleeping"]
+    assert sorted(Dog._state_adaptor.events) == ["run", "sleep"]
+    assert Dog._state_adaptor.events_by_state == {
+        "sleeping": ["run"],
+        "running": ["sleep"],
+    }
+    assert GuideDog._state_adaptor.states == ["running", "sleeping", "guiding"]
+    assert GuideDog._state_adaptor.events_by_state == {
+        "sleeping": ["run"],
+        "running": ["guide", "sleep"],
+        "guiding": ["sleep"],
+    }
+
+    dog = GuideDog()
+    assert dog.is_sleeping
+    dog.run()
+    dog.guide()
+    assert dog.is_guiding
+    assert dog.get_next_event_names() == ["sleep"]
+    dog.sleep()
+    assert dog.is_sleeping
+    assert things_done == ["guided"]
+    assert not hasattr(Dog(), "guide")
+
+
+def test_state_machine_extension_scans_mixins_and_intermediate_classes():
+    @acts_as_state_machine
+    class Base(object):
+        a = State(initial=True)
+        b = State()
+
+        go = Event(from_states=a, to_state=b)
+
+    class Mid(Base):
+        e = State()
+
+        toe = Event(from_states=Base.a, to_state=e)
+
+    @acts_as_state_machine
+    class Leaf(Mid):
+        pass
+
+    class Mixin(object):
+        m = State()
+
+        tom = Event(from_states=Base.a, to_state=m)
+
+    @acts_as_state_machine
+    class MixedLeaf(Base, Mixin):
+        pass
+
+    leaf = Leaf()
+    assert sorted(Leaf._state_adaptor.events) == ["go", "toe"]
+    leaf.toe()
+    assert leaf.is_e
+
+    mixed = MixedLeaf()
+    assert not mixed.is_m
+    mixed.tom()
+    assert mixed.is_m
+    assert sorted(Base._state_adaptor.events) == ["go"]
+
+
+def test_state_entry_and_exit_callbacks():
+    @acts_as_state_machine
+    class Robot(object):
+        sleeping = State(initial=True)
+        running = State()
+        cleaning = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        cleanup = Event(from_states=running, to_state=cleaning)
+        sleep = Event(from_states=(running, cleaning), to_state=sleeping)
+
+        @before("sleep")
+        def yawn(self):
+            things_done.append("before sleep")
+
+        @on_exit("running")
+        def stop_running(self):
+            things_done.append("exit running")
+
+        @on_enter("sleeping")
+        def lie_down(self):
+            things_done.append("enter sleeping")
+
+        @after("sleep")
+        def snore(self):
+            things_done.append("after sleep")
+
+    things_done = []
+    robot = Robot()
+    robot.run()
+    assert things_done == []
+    robot.sleep()
+    assert things_done == [
+        "before sleep",
+        "exit running",
+        "enter sleeping",
+        "after sleep",
+    ]
+
+    del things_done[:]
+    robot.run()
+    robot.cleanup()
+    assert things_done == ["exit running"]
+
+
+def test_exit_callback_can_block_transition():
+    @acts_as_state_machine
+    class Robot(object):
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+        @on_exit("sleeping")
+        def refuse(self):
+            return False
+
+    robot = Robot()
+    robot.run()
+    assert robot.is_sleeping
+
+
+def test_after_batch_callbacks_run_inline_without_deferral():
+    from statu import after_batch
+
+    @acts_as_state_machine
+    class Robot(object):
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+        @after_batch("run")
+        def count(cls, robots):
+            batches.append((cls, robots))
+
+    batches = []
+    robot = Robot()
+    robot.run()
+    assert batches == [(Robot, [robot])]
+
+
+def test_key_value_adaptor():
+    from statu.orm.keyvalue import LocalStore
+
+    store = LocalStore()
+
+    @acts_as_state_machine
+    class Job(object):
+        __state_store__ = store
+
+        queued = State(initial=True)
+        running = State()
+
+        start = Event(from_states=queued, to_state=running)
+
+        def __init__(self, id):
+            self.id = id
+
+    job = Job(1)
+    job.start()
+    assert store.data == {"Job:1": "running"}
+
+    jobs = Job.load_states([Job(1), Job(2)])
+    assert [j.current_state for j in jobs] == ["running", "queued"]
+
+    with Job.state_batch():
+        jobs[1].start()
+        assert "Job:2" not in store.data
+    assert store.data["Job:2"] == "running"
+
+    job = Job(3)
+    with pytest.raises(RuntimeError):
+        with Job.state_batch():
+            job.start()
+            raise RuntimeError
+    assert job.is_running
+    assert store.data["Job:3"] == "running"
+
+
+@pytest.mark.parametrize("compile_events", [False, True])
+def test_shared_state_adaptor(compile_events):
+    import multiprocessing
+    from statu import InvalidStateTransition
+    from statu.orm.shared import SharedStateArray
+
+    pytest.importorskip("multiprocessing.shared_memory")
+    if "fork" not in multiprocessing.get_all_start_methods():
+        pytest.skip("the fork start method is not available")
+
+    store = SharedStateArray(8)
+    try:
+
+        @acts_as_state_machine(compile_events=compile_events)
+        class Job(object):
+            __state_store__ = store
+
+            queued = State(initial=True)
+            running = State()
+
+            start = Event(from_states=queued, to_state=running)
+
+            def __init__(self, slot):
+                self.slot = slot
+
+        job = Job(3)
+        assert job.is_queued
+        job.start()
+        assert Job(3).is_running
+        with pytest.raises(InvalidStateTransition):
+            job.start()
+
+        # workers race to start every job; each one starts exactly once
+        context = multiprocessing.get_context("fork")
+        started = context.Queue()
+
+        def work():
+            count = 0
+            for slot in range(8):
+                try:
+                    Job(slot).start()
+                    count += 1
+                except InvalidStateTransition:
+                    pass
+            started.put(count)
+
+        workers = [context.Process(target=work) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        assert sum(started.get(timeout=10) for _ in workers) == 7
+        for worker in workers:
+            worker.join()
+        assert all(Job(slot).is_running for slot in range(8))
+    finally:
+        store.close()
+        store.unlink()
+
+
+@pytest.mark.parametrize("compile_events", [False, True])
+def test_register_adaptor(compile_events):
+    from statu import register_adaptor, unregister_adaptor
+    from statu.orm import NullAdaptor
+
+    class RecordingAdaptor(NullAdaptor):
+        def update(self, document, state_name):
+            updates.append(state_name)
+            super(RecordingAdaptor, self).update(document, state_name)
+
+    @register_adaptor
+    def get_recording_adaptor(original_class, **options):
+        if getattr(original_class, "recorded", False):
+            return RecordingAdaptor(original_class, **options)
+
+    try:
+
+        @acts_as_state_machine(compile_events=compile_events)
+        class Robot(object):
+            recorded = True
+
+            sleeping = State(initial=True)
+            running = State()
+
+            run = Event(from_states=sleeping, to_state=running)
+
+    finally:
+        unregister_adaptor(get_recording_adaptor)
+
+    updates = []
+    Robot().run()
+    assert updates == ["running"]
+
+
+def test_count_by_state_and_event():
+    @acts_as_state_machine
+    class Robot(object):
+        sleeping = State(initial=True)
+        running = State()
+        cleaning = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        cleanup = Event(from_states=running, to_state=cleaning)
+        sleep = Event(from_states=(running, cleaning), to_state=sleeping)
+
+    robots = [Robot() for _ in range(5)]
+    robots[0].run()
+    robots[1].run()
+    robots[1].cleanup()
+    robots[4].aasm_state = "retired"
+
+    assert Robot.count_by_state(iter(robots)) == {
+        "sleeping": 2,
+        "running": 1,
+        "cleaning": 1,
+    }
+    assert Robot.count_by_event(robots) == {"run": 2, "cleanup": 1, "sleep": 2}
+
+
+def test_track_state_changes():
+    @acts_as_state_machine(track_state_changes=True)
+    class Ticket(object):
+        opened = State(initial=True)
+        review = State()
+
+        submit = Event(from_states=opened, to_state=review)
+
+        def __init__(self, title):
+            self.title = title
+
+    ticket = Ticket("broken")
+    assert ticket.title == "broken"
+    assert ticket.state_changed_at is not None
+    assert 0 <= ticket.time_in_state < 5
+
+    ticket.state_changed_at -= 3600
+    ticket.submit()
+    assert ticket.time_in_state < 5
+
+    stale = Ticket("stale")
+    stale.submit()
+    stale.state_changed_at -= 7200
+    now = ticket.state_changed_at + 1
+    assert Ticket.count_stuck([ticket, stale], 3600, now=now) == {
+        "opened": 0,
+        "review": 1,
+    }
+
+
+def test_compiled_event_methods():
+    from statu import InvalidStateTransition
+
+    @acts_as_state_machine(compile_events=True)
+    class Robot(object):
+        sleeping = State(initial=True)
+        running = State()
+        cleaning = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        cleanup = Event(from_states=running, to_state=cleaning)
+        sleep = Event(from_states=(running, cleaning), to_state=sleeping)
+
+        @before("sleep")
+        def yawn(self):
+            things_done.append("yawn")
+            return not self.wired
+
+        @on_exit("cleaning")
+        def put_away_mop(self):
+            things_done.append("mop")
+
+        @after("sleep")
+        def snore(self):
+            things_done.append("snore")
+
+        wired = False
+
+    @with_state_machine_events
+    class Android(Robot):
+        @before("run")
+        def stretch(self):
+            things_done.append("stretch")
+
+    things_done = []
+    assert Robot.run.__name__ == "run"
+
+    robot = Robot()
+    with pytest.raises(InvalidStateTransition):
+        robot.sleep()
+    robot.run()
+    robot.sleep()
+    assert robot.is_sleeping
+    assert things_done == ["yawn", "snore"]
+
+    del things_done[:]
+    robot.run()
+    robot.cleanup()
+    robot.wired = True
+    robot.sleep()
+    assert robot.is_cleaning
+    assert things_done == ["yawn"]
+    robot.wired = False
+    robot.sleep()
+    assert things_done == ["yawn", "yawn", "mop", "snore"]
+
+    del things_done[:]
+    Android().run()
+    assert things_done == ["stretch"]
+
+
+def test_stream_transitions():
+    from statu.orm.keyvalue import LocalStore
+    from statu.stream import stream_transitions, INVALID, OK, VETOED
+
+    store = LocalStore()
+
+    @acts_as_state_machine
+    class Job(object):
+        __state_store__ = store
+
+        queued = State(initial=True)
+        running = State()
+
+        start = Event(from_states=queued, to_state=running)
+
+        @before("start")
+        def check(self):
+            return self.id != 3
+
+        def __init__(self, id):
+            self.id = id
+
+    jobs = [Job(i) for i in range(1, 6)]
+    jobs[1].start()
+
+    results = stream_transitions(iter(jobs), event="start", flush_every=2)
+    first = next(results)
+    assert first.status == OK
+    assert store.data == {"Job:1": "running", "Job:2": "running"}
+
+    # no batch is left open while the stream is suspended
+    Job(99).start()
+    assert store.data["Job:99"] == "running"
+    assert [result.status for result in results] == [INVALID, VETOED, OK, OK]
+    assert store.data["Job:5"] == "running"
+
+    pairs = [(jobs[2], "start"), (jobs[0], "start")]
+    assert [r.status for r in stream_transitions(pairs)] == [VETOED, INVALID]
+
+
+@pytest.mark.parametrize("locking", [True, 8])
+@pytest.mark.parametrize("compile_events", [False, True])
+def test_locking_serialises_transitions(locking, compile_events):
+    import threading
+    import time
+    from statu import InvalidStateTransition
+
+    @acts_as_state_machine(locking=locking, compile_events=compile_events)
+    class Account(object):
+        open = State(initial=True)
+        closed = State()
+
+        close = Event(from_states=open, to_state=closed)
+
+        @before("close")
+        def settle(self):
+            time.sleep(0.01)
+
+        @after("close")
+        def notify(self):
+            closed.append(self)
+
+    account = Account()
+    closed, invalid = [], []
+    start = threading.Barrier(4)
+
+    def close():
+        start.wait()
+        try:
+            account.close()
+        except InvalidStateTransition:
+            invalid.append(account)
+
+    threads = [threading.Thread(target=close) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(closed) == 1
+    assert len(invalid) == 3
+
+
+def test_describe_machine():
+    import json
+    from statu import describe_machine
+
+    @acts_as_state_machine
+    class Dog(object):
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        sleep = Event(from_states=(running,), to_state=sleeping)
+
+        @before("run")
+        def stretch(self):
+            pass
+
+    class Labrador(Dog):
+        pass
+
+    @with_state_machine_events
+    class Puppy(Dog):
+        @before("run")
+        def wag(self):
+            pass
+
+    descriptor = describe_machine(Dog)
+    assert descriptor.states == ("sleeping", "running")
+    assert descriptor.initial == "sleeping"
+    assert descriptor.transitions == (
+        ("sleeping", "run", "running"),
+        ("running", "sleep", "sleeping"),
+    )
+    assert descriptor.callbacks == ((("before", "run"), 1),)
+    assert describe_machine(Dog) is descriptor
+    assert describe_machine(Labrador) is descriptor
+    assert describe_machine(Puppy).callbacks == ((("before", "run"), 2),)
+    assert hash(descriptor) == hash(describe_machine(Labrador))
+
+    assert json.loads(descriptor.to_json())["events"][0] == {
+        "name": "run",
+        "from_states": ["sleeping"],
+        "to_state": "running",
+    }
+    dot = descriptor.to_dot()
+    assert '"sleeping" [shape=doublecircle];' in dot
+    assert '"sleeping" -> "running" [label="run"];' in dot
+    assert "Dog" not in dot
+    assert "name" not in descriptor.to_dict()
+
+    exported = describe_machine(Labrador)
+    assert exported.to_dot("Labrador").startswith('digraph "Labrador" {')
+    assert json.loads(exported.to_json("Labrador"))["name"] == "Labrador"
+    assert "Dog" not in exported.to_json("Labrador")
+
+
+@pytest.mark.parametrize("compile_events", [False, True])
+def test_profiling_callbacks(compile_events):
+    import time
+    from statu import profiling
+
+    @acts_as_state_machine(compile_events=compile_events)
+    class Robot(object):
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        sleep = Event(from_states=running, to_state=sleeping)
+
+        @before("run")
+        def warm_up(self):
+            time.sleep(0.01)
+
+        @after("run")
+        def report(self):
+            pass
+
+    robot = Robot()
+    robot.run()
+    robot.sleep()
+    assert not profiling.is_enabled()
+    assert profiling.report() == []
+
+    with profiling.profile() as profiler:
+        robot.run()
+        robot.sleep()
+        robot.run()
+    assert not profiling.is_enabled()
+    assert profiling.report() == []
+
+    slowest = profiler.report(top=1)
+    assert len(slowest) == 1
+    assert slowest[0].document_class == "Robot"
+    assert slowest[0].event == "run"
+    assert slowest[0].callback.endswith("warm_up")
+    assert slowest[0].calls == 2
+    assert slowest[0].total >= 0.02
+    assert [stats.callback.rsplit(".", 1)[-1] for stats in profiler.report()] == [
+        "warm_up",
+        "report",
+    ]
+
+    # back to the unwrapped callbacks
+    robot.sleep()
+    robot.run()
+    assert profiler.report(top=1)[0].calls == 2
+
+
+def test_import_statu_is_lightweight():
+    import json
+    import subprocess
+    import sys
+
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import statu\n"
+        "elapsed = time.perf_counter() - start\n"
+        "print(json.dumps([elapsed, sorted(sys.modules)]))\n"
+    )
+    elapsed, modules = json.loads(subprocess.check_output([sys.executable, "-c", code]))
+    heavy = [
+        m
+        for m in modules
+        if m.split(".")[0] in ("sqlalchemy", "asyncio", "multiprocessing")
+    ]
+    assert heavy == []
+    assert elapsed < 0.5
+
+
+@pytest.mark.parametrize("use_numpy", [False, True])
+def test_simulation(use_numpy):
+    import math
+    from statu import simulation
+
+    if use_numpy and simulation.numpy is None:
+        pytest.skip("numpy is not installed")
+
+    @acts_as_state_machine
+    class Ticket(object):
+        opened = State(initial=True)
+        review = State()
+        closed = State()
+
+        submit = Event(from_states=opened, to_state=review)
+        approve = Event(from_states=review, to_state=closed)
+        reject = Event(from_states=review, to_state=opened)
+
+    result = simulation.simulate(
+        Ticket,
+        {"submit": 1.0, "approve": 3.0, "reject": 1.0},
+        instances=5000,
+        duration=20.0,
+        samples=20,
+        seed=7,
+        use_numpy=use_numpy,
+    )
+    assert result.states == ("opened", "review", "closed")
+    assert result.times[1] == 1.0
+    for k in range(20):
+        assert sum(result.occupancy[state][k] for state in result.states) == 5000
+    assert result.occupancy["opened"][0] == 5000
+    assert result.final["closed"] > 4900
+
+    opened = result.time_in_state["opened"]
+    review = result.time_in_state["review"]
+    assert abs(opened.mean - 1.0) < 0.1
+    assert abs(review.mean - 0.25) < 0.03
+    assert review.count == sum(review.histogram)
+    assert result.transitions == opened.count + review.count
+    # at least the e^-1 that never left are still open after one unit of time
+    assert result.occupancy["opened"][1] / 5000.0 > math.exp(-1) - 0.02
+
+    with pytest.raises(ValueError):
+        simulation.simulate(Ticket, {"escalate": 1.0})
+
+    @acts_as_state_machine
+    class Order(object):
+        awaiting_payment = State(initial=True, timeout=120, on_timeout="expire")
+        paid = State()
+        expired = State()
+
+        pay = Event(from_states=awaiting_payment, to_state=paid)
+        expire = Event(from_states=awaiting_payment, to_state=expired)
+
+    # timeouts are in seconds and the rates per minute
+    result = simulation.simulate(
+        Order, {"pay": 0.5}, instances=5000, seed=7, use_numpy=use_numpy, time_unit=60
+    )
+    assert abs(result.final["expired"] / 5000.0 - math.exp(-1)) < 0.03
+    awaiting = result.time_in_state["awaiting_payment"]
+    assert abs(awaiting.mean - (1 - math.exp(-1)) / 0.5) < 0.05
+
+
 ###################################################################################
 ## SqlAlchemy Tests
 ###################################################################################
@@ -384,6 +1090,432 @@ def test_sqlalchemy_state_machine_using_initial_state():
     assert penguin2.is_sleeping
 
 
+@requires_sqlalchemy
+def test_sqlalchemy_sweep_timeouts():
+    import datetime
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+
+    Base = declarative_base()
+    engine = sqlalchemy.create_engine("sqlite:///:memory:")
+
+    @acts_as_state_machine
+    class Invoice(Base):
+        __tablename__ = "invoices"
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        updated_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+        created = State(initial=True)
+        awaiting_payment = State(
+            timeout=datetime.timedelta(minutes=15), on_timeout="expire"
+        )
+        expired = State()
+
+        checkout = Event(from_states=created, to_state=awaiting_payment)
+        expire = Event(from_states=awaiting_payment, to_state=expired)
+
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    now = datetime.datetime(2020, 1, 1, 12, 0)
+    stale, fresh = Invoice(), Invoice()
+    for invoice, age in ((stale, 20), (fresh, 5)):
+        invoice.checkout()
+        invoice.updated_at = now - datetime.timedelta(minutes=age)
+        session.add(invoice)
+    session.commit()
+
+    assert Invoice.sweep_timeouts(session, Invoice.updated_at, now=now) == {
+        "awaiting_payment": 1
+    }
+    session.expire_all()
+    assert stale.is_expired
+    assert stale.updated_at == now
+    assert fresh.is_awaiting_payment
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_deferred_after_callbacks():
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+    from statu import after_batch
+
+    Base = declarative_base()
+    engine = sqlalchemy.create_engine("sqlite:///:memory:")
+
+    @acts_as_state_machine(defer_after_callbacks=True)
+    class Parcel(Base):
+        __tablename__ = "parcels"
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        name = sqlalchemy.Column(sqlalchemy.String)
+
+        packed = State(initial=True)
+        shipped = State()
+
+        ship = Event(from_states=packed, to_state=shipped)
+        unship = Event(from_states=shipped, to_state=packed)
+
+        @after("ship")
+        def notify(self):
+            notified.append(self.name)
+
+        @after_batch("ship")
+        def invalidate(cls, parcels):
+            batches.append(sorted(parcel.name for parcel in parcels))
+
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    notified, batches = [], []
+
+    parcels = [Parcel(name="a"), Parcel(name="b")]
+    session.add_all(parcels)
+    session.commit()
+
+    for parcel in parcels:
+        parcel.ship()
+    assert notified == [] and batches == []
+    session.commit()
+    assert notified == ["a", "b"]
+    assert batches == [["a", "b"]]
+
+    for parcel in parcels:
+        parcel.unship()
+    session.commit()
+    parcels[0].ship()
+    session.rollback()
+    session.commit()
+    assert notified == ["a", "b"]
+    assert batches == [["a", "b"]]
+
+    # savepoints neither run nor drop what the enclosing transaction queued
+    parcels[0].ship()
+    session.begin_nested().commit()
+    assert notified == ["a", "b"]
+    session.rollback()
+    assert notified == ["a", "b"]
+    assert parcels[0].is_packed
+
+    parcels[0].ship()
+    session.begin_nested().rollback()
+    session.commit()
+    assert notified == ["a", "b", "a"]
+
+    # what a savepoint queued runs on the outer commit, unless it rolls back
+    savepoint = session.begin_nested()
+    parcels[0].unship()
+    parcels[0].ship()
+    savepoint.rollback()
+    savepoint = session.begin_nested()
+    parcels[1].ship()
+    savepoint.commit()
+    assert notified == ["a", "b", "a"]
+    session.commit()
+    assert notified == ["a", "b", "a", "b"]
+    assert batches == [["a", "b"], ["a"], ["b"]]
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_state_cache():
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+    from statu.cache import StateCache
+
+    Base = declarative_base()
+    engine = sqlalchemy.create_engine("sqlite:///:memory:")
+    cache = StateCache(maxsize=10, ttl=60)
+
+    @acts_as_state_machine(state_cache=cache)
+    class Ticket(Base):
+        __tablename__ = "tickets"
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+        opened = State(initial=True)
+        closed = State()
+
+        close = Event(from_states=opened, to_state=closed)
+        reopen = Event(from_states=closed, to_state=opened)
+
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    tickets = [Ticket(), Ticket(), Ticket()]
+    session.add_all(tickets)
+    session.commit()
+
+    # loading rows fills the cache
+    session.query(Ticket).filter(Ticket.id == 1).one()
+    assert cache.get(1) == "opened"
+
+    queries = []
+    sqlalchemy.event.listen(
+        engine, "before_cursor_execute", lambda *args: queries.append(args[2])
+    )
+    assert Ticket.get_states(session, [1, 2, 3, 4]) == {
+        1: "opened",
+        2: "opened",
+        3: "opened",
+    }
+    assert len(queries) == 1
+    assert Ticket.get_states(session, [1, 2, 3]) == {
+        1: "opened",
+        2: "opened",
+        3: "opened",
+    }
+    assert len(queries) == 1
+
+    # transitions invalidate until the commit, rollbacks drop the entry
+    tickets[0].close()
+    assert cache.get(1) is None
+    session.commit()
+    assert cache.get(1) == "closed"
+
+    tickets[0].reopen()
+    session.flush()
+    session.rollback()
+    assert cache.get(1) is None
+    assert Ticket.get_states(session, [1]) == {1: "closed"}
+
+    # a released savepoint is not a commit
+    tickets[1].close()
+    savepoint = session.begin_nested()
+    session.flush()
+    savepoint.commit()
+    assert cache.get(2) is None
+    session.rollback()
+    assert cache.get(2) is None
+    assert Ticket.get_states(session, [2]) == {2: "opened"}
+
+    # nor is a commit after a rolled back savepoint proof of its states
+    session.query(Ticket).filter(Ticket.id == 3).one()
+    savepoint = session.begin_nested()
+    tickets[2].close()
+    session.flush()
+    savepoint.rollback()
+    session.commit()
+    assert cache.get(3) is None
+    assert Ticket.get_states(session, [3]) == {3: "opened"}
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_state_cache_composite_primary_key():
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+
+    Base = declarative_base()
+    engine = sqlalchemy.create_engine("sqlite:///:memory:")
+
+    @acts_as_state_machine(state_cache=True)
+    class Seat(Base):
+        __tablename__ = "seats"
+        row = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        number = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+        free = State(initial=True)
+        taken = State()
+
+        take = Event(from_states=free, to_state=taken)
+
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    seats = [Seat(row=1, number=2), Seat(row=2, number=1)]
+    seats[0].take()
+    session.add_all(seats)
+    session.commit()
+
+    assert Seat.get_states(session, [(1, 2), (2, 1), (1, 1)]) == {
+        (1, 2): "taken",
+        (2, 1): "free",
+    }
+    assert Seat._state_adaptor.state_cache.get((1, 2)) == "taken"
+    assert Seat.available_events(session) == {(1, 2): [], (2, 1): ["take"]}
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_state_aggregates():
+    import datetime
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+
+    Base = declarative_base()
+    engine = sqlalchemy.create_engine("sqlite:///:memory:")
+
+    @acts_as_state_machine
+    class Order(Base):
+        __tablename__ = "orders"
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        updated_at = sqlalchemy.Column(sqlalchemy.DateTime)
+
+        created = State(initial=True)
+        paid = State()
+        shipped = State()
+
+        pay = Event(from_states=created, to_state=paid)
+        ship = Event(from_states=paid, to_state=shipped)
+        cancel = Event(from_states=(created, paid), to_state=shipped)
+
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    now = datetime.datetime(2020, 1, 1)
+    orders = [Order(updated_at=now - datetime.timedelta(hours=i)) for i in range(4)]
+    orders[2].pay()
+    orders[3].pay()
+    session.add_all(orders)
+    session.commit()
+
+    assert Order.count_by_state(session) == {"created": 2, "paid": 2, "shipped": 0}
+    assert Order.count_by_state(session.query(Order).filter(Order.id > 3)) == {
+        "created": 0,
+        "paid": 1,
+        "shipped": 0,
+    }
+    assert Order.count_by_event(session) == {"pay": 2, "ship": 2, "cancel": 4}
+    assert Order.count_stuck(
+        session, datetime.timedelta(minutes=90), Order.updated_at, now=now
+    ) == {"created": 0, "paid": 2, "shipped": 0}
+    assert Order.available_events(session.query(Order).filter(Order.id > 1)) == {
+        2: ["cancel", "pay"],
+        3: ["cancel", "ship"],
+        4: ["cancel", "ship"],
+    }
+    assert Order.available_events(session, ids=[1, 4, 99]) == {
+        1: ["cancel", "pay"],
+        4: ["cancel", "ship"],
+    }
+
+    # rows in undeclared states are left out
+    session.add_all([Order(aasm_state="legacy"), Order(aasm_state=None)])
+    session.flush()
+    assert Order.count_by_state(session) == {"created": 2, "paid": 2, "shipped": 0}
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_stream_transitions_flushes_chunks():
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+    from statu.stream import stream_transitions
+
+    Base = declarative_base()
+    engine = sqlalchemy.create_engine("sqlite:///:memory:")
+
+    @acts_as_state_machine
+    class Record(Base):
+        __tablename__ = "records"
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+        raw = State(initial=True)
+        loaded = State()
+
+        load = Event(from_states=raw, to_state=loaded)
+
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine, autoflush=False)()
+    session.add_all(Record() for _ in range(5))
+    session.commit()
+
+    def loaded_in_db():
+        return session.query(Record).filter(Record.is_loaded).with_entities(
+            sqlalchemy.func.count()
+        ).scalar()
+
+    results = stream_transitions(
+        session.query(Record).order_by(Record.id), event="load", flush_every=2
+    )
+    next(results)
+    assert loaded_in_db() == 2
+    assert len(list(results)) == 4
+    assert loaded_in_db() == 5
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_track_state_changes():
+    import datetime
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+
+    Base = declarative_base()
+    engine = sqlalchemy.create_engine("sqlite:///:memory:")
+
+    @acts_as_state_machine(track_state_changes=True)
+    class Ticket(Base):
+        __tablename__ = "tickets"
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+        opened = State(initial=True)
+        review = State(timeout=datetime.timedelta(hours=1), on_timeout="escalate")
+        escalated = State()
+
+        submit = Event(from_states=opened, to_state=review)
+        escalate = Event(from_states=review, to_state=escalated)
+
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    indexes = sqlalchemy.inspect(engine).get_indexes("tickets")
+    assert [index["column_names"] for index in indexes] == [
+        ["aasm_state", "state_changed_at"]
+    ]
+
+    stale, fresh = Ticket(), Ticket()
+    assert 0 <= fresh.time_in_state < 5
+    stale.submit()
+    fresh.submit()
+    now = fresh.state_changed_at
+    stale.state_changed_at = now - datetime.timedelta(hours=2)
+    session.add_all([stale, fresh])
+    session.commit()
+
+    statements = []
+    sqlalchemy.event.listen(
+        engine,
+        "before_cursor_execute",
+        lambda _conn, _cursor, statement, parameters, *args: statements.append(
+            (statement, parameters)
+        ),
+    )
+    assert Ticket.count_stuck(session, 3600, now=now) == {
+        "opened": 0,
+        "review": 1,
+        "escalated": 0,
+    }
+    statement, parameters = statements[-1]
+    plan = " ".join(
+        str(row[-1])
+        for row in session.connection().connection.execute(
+            "EXPLAIN QUERY PLAN " + statement, parameters
+        )
+    )
+    assert "SEARCH" in plan
+    assert "ix_tickets_aasm_state_changed_at" in plan
+    assert Ticket.sweep_timeouts(session, now=now) == {"review": 1}
+    session.expire_all()
+    assert stale.is_escalated
+    assert stale.state_changed_at == now
+    assert fresh.is_review
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_describe_machine_before_mappers_are_configured():
+    from sqlalchemy.ext.declarative import declarative_base
+    from statu import describe_machine
+
+    Base = declarative_base()
+
+    @acts_as_state_machine
+    class Ticket(Base):
+        __tablename__ = "tickets"
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+        opened = State(initial=True)
+        closed = State()
+
+        close = Event(from_states=opened, to_state=closed)
+
+    descriptor = describe_machine(Ticket)
+    assert descriptor.states == ("opened", "closed")
+    assert descriptor.initial == "opened"
+    assert describe_machine(Ticket) is descriptor
+
+
 def test_events_and_next_event_names():
     @acts_as_state_machine
     class Robot:
@@ -441,3 +1573,115 @@ def test_events_and_next_event_names():
     dynamic_event_method = next_event_methods["run"]
     dynamic_event_method()
     assert robot.is_running
+
+
+def test_timed_state_fires_timeout_event():
+    from statu.timeouts import TimeoutScheduler
+
+    @acts_as_state_machine
+    class Order(object):
+        created = State(initial=True)
+        awaiting_payment = State(timeout=15 * 60, on_timeout="expire")
+        paid = State()
+        expired = State()
+
+        checkout = Event(from_states=created, to_state=awaiting_payment)
+        pay = Event(from_states=awaiting_payment, to_state=paid)
+        expire = Event(from_states=awaiting_payment, to_state=expired)
+
+    now = [0.0]
+    scheduler = TimeoutScheduler(clock=lambda: now[0])
+    late, prompt = Order(), Order()
+    scheduler.watch(late)
+    scheduler.watch(prompt)
+    assert len(scheduler) == 0
+
+    late.checkout()
+    prompt.checkout()
+    assert len(scheduler) == 2
+    assert scheduler.next_deadline() == 15 * 60
+
+    # leaving the timed state cancels its deadline
+    prompt.pay()
+    assert len(scheduler) == 1
+
+    now[0] = 15 * 60 - 1
+    assert scheduler.run_pending() == []
+    now[0] = 15 * 60
+    assert scheduler.run_pending() == [late]
+    assert late.is_expired
+    assert prompt.is_paid
+    assert scheduler.next_deadline() is None
+
+
+def test_timeout_scheduler_drivers():
+    import asyncio
+    import time
+    from statu.timeouts import TimeoutScheduler
+
+    @acts_as_state_machine
+    class Robot(object):
+        sleeping = State(initial=True)
+
+    @acts_as_state_machine
+    class Order(object):
+        created = State(initial=True)
+        awaiting_payment = State(timeout=0.05, on_timeout="expire")
+        expired = State()
+
+        checkout = Event(from_states=created, to_state=awaiting_payment)
+        expire = Event(from_states=awaiting_payment, to_state=expired)
+
+    scheduler = TimeoutScheduler()
+    scheduler.watch(Robot())
+    assert len(scheduler) == 0
+
+    def wait_for(condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    # background thread
+    order = Order()
+    scheduler.watch(order)
+    scheduler.start()
+    try:
+        order.checkout()
+        assert wait_for(lambda: order.is_expired)
+    finally:
+        scheduler.stop()
+    assert scheduler._thread is None
+
+    # asyncio task
+    async def run():
+        order = Order()
+        scheduler.watch(order)
+        task = asyncio.ensure_future(scheduler.run_async(poll_interval=0.01))
+        order.checkout()
+        for _ in range(500):
+            if order.is_expired:
+                break
+            await asyncio.sleep(0.01)
+        scheduler.stop()
+        await task
+        return order
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(run()).is_expired
+    finally:
+        loop.close()
+
+
+def test_timed_state_requires_reachable_timeout_event():
+    with pytest.raises(ValueError):
+
+        @acts_as_state_machine
+        class Order(object):
+            created = State(initial=True)
+            awaiting_payment = State(timeout=60, on_timeout="expire")
+            expired = State()
+
+            checkout = Event(from_states=created, to_state=awaiting_payment)
+            expire = Event(from_states=created, to_state=expired)